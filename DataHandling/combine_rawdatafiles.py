@@ -7,15 +7,36 @@ Combine the raw data files into one hour datafiles
 - create the hourly data file if it missing
 - add the data from the current file to the new hourly file,
   but only if there is no data from those times already
+
+The raw files are the records of the receiver (*.dope, see
+dopplerrecord.py) or older np.savez files (*.npz). Files with several
+channels (O and X mode) have the samples as (channels, samples), and so
+will the hourly files. The hourly files have no time stamp per sample, the
+samples are on the integer sample clock (see hourfile.py). The samples
+that the receiver replaced with zeros (the gap table of a record) are not
+merged, so they are missing from the hour file as the samples of any
+other gap are. The coverage sidecar of an hour file (see coverage.py) is
+updated with each merge.
+
+With -j N the files are merged by N processes: the headers of all the
+files are read first and the files are grouped by the hour files they go
+to, and each hour is then merged by one process, in the same order as
+one process would do it, so the hour files are the same.
 """
 
 import argparse
+import concurrent.futures
 import numpy as np
 import glob
 import os
 import datetime as dt
 import logging
 import pathlib
+import time
+from dopplerrecord import load_samples, read_header, read_record
+from coverage import write_coverage
+from hourfile import append_hour, merge_spans, read_hour, read_spans, \
+    uncovered
 
 
 def parse_args():
@@ -25,49 +46,258 @@ def parse_args():
     parser.add_argument("-n", "--dry-run", action="store_true")
     parser.add_argument("-d", "--delete-files", action="store_true")
     parser.add_argument("-i", "--input-directory", required=True)
-    parser.add_argument("-o", "--output-directory", default="/dev/shm/Doppler")
+    parser.add_argument("-o", "--output-directory",
+                        default="/home/aurora/Data")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes merging the hours "
+                        "(default 1)")
     return parser.parse_args()
 
-# The following code uses a shortcut, where we assume that
-# there are no overlaps between the raw IQ files. So, if one or more of the
-# samples are missing from the hourly file, then all samples from the
-# raw datafile are added to that hour. Perhaps a better way would be
-# to raise an exception if the merge would result in duplicate samples?
+# The samples are placed on the integer sample clock (the sample index at
+# fs since 1970, see hourfile.py). Only the samples that an hour file does
+# not have yet are merged, so the same data is never added twice, and data
+# that overlaps partly with the hour file is reported.
+
+
+def record_missing(gaps, factor):
+    """The samples at fs with zeros from the receiver, as merged spans
+
+    gaps is the gap table of a record, (sample counter, length) at the
+    receiver rate. A decimated sample is missing if any of the input
+    samples of its sample period is.
+    """
+    gaps = np.asarray(gaps, dtype=np.int64).reshape(-1, 2)
+    return merge_spans(np.column_stack((gaps[:, 0]//factor,
+                                        -(-(gaps[:, 0]+gaps[:, 1])//factor))))
+
+
+def load_raw_file(filename):
+    """Samples of a raw file with their times
+
+    Returns the samples, the sample index of the samples at fs (from 1970),
+    fs and the spans of the sample index that the receiver filled with
+    zeros. The records are on the sample grid; the times of the npz files
+    are floats, and the samples are put on the nearest sample of the grid.
+    """
+    if filename.endswith(".dope"):
+        info, samples, gaps = read_record(filename)
+        if samples.shape[0] == 1:
+            samples = samples[0]
+        index = info["start_count"]//info["factor"] + \
+            np.arange(samples.shape[-1], dtype=np.int64)
+        return samples, index, info["fs"], record_missing(gaps,
+                                                          info["factor"])
+    ts, fs, samples = load_samples(filename)
+    if samples.ndim > 1 and samples.shape[0] == 1:
+        samples = samples.flatten()
+    # The timestamp is for the first sample and the rest of the samples
+    # are at a regular rate
+    index = int(np.round(ts*fs))+np.arange(samples.shape[-1], dtype=np.int64)
+    return samples, index, fs, np.empty((0, 2), dtype=np.int64)
+
+
+def file_hours(filename):
+    """The hours (since 1970) that a raw file has samples in
+
+    Only the header of a record is read.
+    """
+    if filename.endswith(".dope"):
+        info = read_header(filename)
+        fs = info["fs"]
+        first = info["start_count"]//info["factor"]
+        last = first+info["nsamples"]-1
+    else:
+        ts, fs, samples = load_samples(filename)
+        if samples.shape[-1] == 0:
+            return []
+        first = int(np.round(ts*fs))
+        last = first+samples.shape[-1]-1
+    return list(range(int(first//(3600*fs)), int(last//(3600*fs))+1))
+
+
+def split_hours(index, fs):
+    """Split samples into the UTC hours by their times
+
+    index are the (increasing) sample indices of the samples at fs.
+    Returns the hours (since 1970) and the bounds of their samples:
+    hours[i] has the samples bounds[i]:bounds[i+1]. Every sample is in
+    exactly one hour, however many hours the samples span.
+    """
+    per_hour = 3600*fs
+    hours = np.arange(index[0]//per_hour, index[-1]//per_hour+1)
+    bounds = np.concatenate(([0], np.searchsorted(index, hours[1:]*per_hour),
+                             [len(index)]))
+    return hours.astype(np.int64), bounds
+
+
+def conflicts(filename, samples, start, parts):
+    """Number of samples that differ from those in the hour file
+
+    samples start at the sample index start, and only the (start, stop)
+    parts of them are compared (those that the hour file has too).
+    """
+    data = read_hour(filename)
+    differ = 0
+    for span, ts, iq in data.chunks:
+        if ts is None:
+            index = np.arange(span[0], span[1], dtype=np.int64)
+        else:
+            index = np.round(ts*data.fs).astype(np.int64)
+        for a, b in parts:
+            inside = (index >= a) & (index < b)
+            if not inside.any():
+                continue
+            stored = iq[..., inside]
+            new = samples[..., index[inside]-start]
+            if stored.shape != new.shape:
+                differ += stored.shape[-1]
+                continue
+            same = stored == new
+            if same.ndim > 1:
+                same = same.all(axis=0)
+            differ += int(np.count_nonzero(~same))
+    return differ
 
 
-def save_to_hour_file(path, filename, tindex, samples):
-    """Save/merge data to one hour datafiles"""
+def save_to_hour_file(path, filename, samples, start, fs, missing=None):
+    """Save/merge data to one hour datafiles
+
+    start is the sample index of the first sample (the samples are
+    consecutive). The samples in the merged spans missing are zeros from
+    the receiver and are left out. The samples that the hour file has
+    already are not merged, with a warning, and compared with the old ones.
+    Returns the number of samples merged.
+    """
     fullfilename = os.path.join(path, filename)
     logging.debug(" -> " + fullfilename)
 
     if os.path.exists(path) is False:
         logging.debug(" ->  Creating a new directory " + path)
-        pathlib.Path(path).mkdir(parents=True)
+        pathlib.Path(path).mkdir(parents=True, exist_ok=True)
 
+    stop = start+samples.shape[-1]
+    if missing is None:
+        missing = np.empty((0, 2), dtype=np.int64)
+    parts = uncovered(start, stop, missing)
+    valid = sum(b-a for a, b in parts)
+    spans = np.empty((0, 2), dtype=np.int64)
+    if valid == 0:
+        logging.debug("\t - no valid samples, nothing merged")
+        return 0
     if os.path.exists(fullfilename):
         logging.debug("\tMerging to existing data...")
-        old_data = np.load(fullfilename)
-        old_tindex = old_data["timestamps"]
-        if np.all(np.in1d(tindex, old_tindex)):
+        hour_fs, spans = read_spans(fullfilename, fs)
+        if hour_fs != fs:
+            logging.error("%s has data at %gHz, %gHz samples not merged" %
+                          (fullfilename, hour_fs, fs))
+            return 0
+        parts = uncovered(start, stop, merge_spans(
+            np.concatenate((spans, missing))))
+        new = sum(b-a for a, b in parts)
+        if new < valid:
+            # The samples the hour file has already should be the same
+            old = uncovered(start, stop, merge_spans(np.concatenate(
+                (missing, np.reshape(parts, (-1, 2))))))
+            differ = conflicts(fullfilename, samples, start, old)
+            if differ:
+                logging.warning("%s already has %d of the samples %d-%d at "
+                                "%gHz and %d of them differ, keeping the "
+                                "old ones, %d new ones merged" %
+                                (fullfilename, valid-new, start, stop, fs,
+                                 differ, new))
+            elif new > 0:
+                logging.warning("%s already has %d of the samples %d-%d at "
+                                "%gHz, merging only the %d new ones" %
+                                (fullfilename, valid-new, start, stop, fs,
+                                 new))
+        if new == 0:
             logging.debug("\t - all data exists already, nothing merged")
-            return
-        else:
+            return 0
+        if new == valid:
             logging.info("\t - merging")
-            tindex = np.concatenate((tindex, old_tindex))
-            samples = np.concatenate((samples, old_data["iq"]))
 
-    np.savez_compressed(fullfilename, timestamps=tindex, iq=samples)
+    # The data is added as new chunks, the old data is not rewritten
+    # (see hourfile.py)
+    for a, b in parts:
+        append_hour(fullfilename, samples[..., a-start:b-start], a, fs)
+    per_hour = int(round(3600*fs))
+    write_coverage(fullfilename, start//per_hour*per_hour, fs,
+                   merge_spans(np.concatenate((spans, parts))))
+    return sum(b-a for a, b in parts)
 
 
-def savecheck(path, filename, tindex, samples):
+def savecheck(path, filename, index, fs, samples):
     """ For checking that the indices go right... """
     print("Would be saving to", os.path.join(path, filename))
-    tsmin = dt.datetime.utcfromtimestamp(np.min(tindex))
-    tsmax = dt.datetime.utcfromtimestamp(np.max(tindex))
+    tsmin = dt.datetime.utcfromtimestamp(np.min(index)/fs)
+    tsmax = dt.datetime.utcfromtimestamp(np.max(index)/fs)
     print("with a range from", tsmin, "to", tsmax)
-    print("tindex.shape =", tindex.shape)
+    print("index.shape =", index.shape)
     print("samples.shape =", samples.shape)
 
+
+def combine_file(filename, output_directory, dry_run=False, only_hour=None):
+    """Merge a raw file into the hour files
+
+    With only_hour, only the samples of that hour (since 1970) are merged.
+    """
+    samples, index, fs, missing = load_raw_file(filename)
+    if len(index) == 0:
+        return
+
+    # The data goes to one hour-file, or is split at the hour edges
+    # if it spans more than one hour
+    hours, bounds = split_hours(index, fs)
+    for hour, a, b in zip(hours, bounds[:-1], bounds[1:]):
+        if a == b or (only_hour is not None and hour != only_hour):
+            continue
+        hourtime = dt.datetime.utcfromtimestamp(int(hour)*3600)
+        hourfile = hourtime.strftime("doppler_lyr_%Y%m%d_%HUT.npz")
+        path = os.path.join(output_directory, hourtime.strftime("%Y"),
+                            hourtime.strftime("%m"), hourtime.strftime("%d"))
+        if dry_run:
+            savecheck(path, hourfile, index[a:b], fs, samples[..., a:b])
+        else:
+            save_to_hour_file(path, hourfile, samples[..., a:b],
+                              int(index[a]), fs, missing)
+
+
+def combine_hour(hour, filenames, output_directory):
+    """Merge the samples of one hour from the raw files (in a worker)"""
+    for filename in filenames:
+        combine_file(filename, output_directory, only_hour=hour)
+
+
+def combine_parallel(myfiles, output_directory, jobs):
+    """Merge the raw files hour by hour in jobs processes
+
+    Each hour file is written by one process only, so no locking is
+    needed. Returns the files that could not be merged completely.
+    """
+    hours = {}
+    failed = set()
+    for filename in myfiles:
+        try:
+            for hour in file_hours(filename):
+                hours.setdefault(hour, []).append(filename)
+        except (OSError, ValueError) as e:
+            logging.error("Cannot read %s: %s" % (filename, e))
+            failed.add(filename)
+    logging.info("%d files for %d hours" % (len(myfiles), len(hours)))
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = {pool.submit(combine_hour, hour, filenames,
+                               output_directory): hour
+                   for hour, filenames in sorted(hours.items())}
+        for future in concurrent.futures.as_completed(futures):
+            hour = futures[future]
+            try:
+                future.result()
+            except Exception:
+                logging.exception("Merging the hour %s failed" %
+                                  dt.datetime.utcfromtimestamp(hour*3600))
+                failed.update(hours[hour])
+    return failed
+
 # ------------------------------------------------------------------
 
 
@@ -78,74 +308,37 @@ def main():
         logging.basicConfig(level=logging.DEBUG)
         logging.debug("Verbose mode")
 
-    myfiles = glob.glob(os.path.join(args.input_directory, "*.npz"))
+    myfiles = glob.glob(os.path.join(args.input_directory, "*.dope")) + \
+        glob.glob(os.path.join(args.input_directory, "*.npz"))
     myfiles.sort()
+    started = time.monotonic()
 
-    for i in np.arange(0, len(myfiles)):
-        print("Processing", myfiles[i])
-        thisdata = np.load(myfiles[i])
-        samples = thisdata["samples"].flatten()
-        ts = thisdata["timestamp"]
-        fs = thisdata["fs"]
-        delta = 1/fs
-
-        # The timestamp in the data file is for the first sample, so
-        # we can use the fact that the rest of the samples are sampled
-        # at a regular rate. So, the data goes either to one single
-        # hour-file or some part of it will need to written to the following
-        # hour-file
-        tindex = ts+np.arange(0, samples.size)*delta
-        mintime = dt.datetime.utcfromtimestamp(np.min(tindex))
-        maxtime = dt.datetime.utcfromtimestamp(np.max(tindex))
-
-        filename = mintime.strftime("doppler_lyr_%Y%m%d_%HUT.npz")
-        filename_ext = maxtime.strftime("doppler_lyr_%Y%m%d_%HUT.npz")
-        path = os.path.join(args.output_directory,
-                            mintime.strftime("%Y"), mintime.strftime("%m"),
-                            mintime.strftime("%d"))
-        path_ext = os.path.join(args.output_directory,
-                                maxtime.strftime("%Y"), maxtime.strftime("%m"),
-                                maxtime.strftime("%d"))
-
-        if filename == filename_ext:
-            if args.dry_run:
-                savecheck(path, filename, tindex, samples)
-            else:
-                save_to_hour_file(path, filename, tindex, samples)
-        else:
-            """ First, find the index where the hour changes"""
-            firsthour = dt.datetime.utcfromtimestamp(tindex[0]).hour
-            secondhour = dt.datetime.utcfromtimestamp(tindex[1]).hour
-            j = 1
-            while firsthour == secondhour:
-                j = j+1
-                secondhour = dt.datetime.utcfromtimestamp(tindex[j]).hour
-            firsthour_end = j-1
-            secondhour_start = j
-            if args.dry_run:
-                savecheck(path, filename,
-                          tindex[0:firsthour_end],
-                          samples[0:firsthour_end])
-                savecheck(path_ext, filename_ext,
-                          tindex[secondhour_start:],
-                          samples[secondhour_start:])
-            else:
-                save_to_hour_file(path, filename,
-                                  tindex[0:firsthour_end],
-                                  samples[0:firsthour_end])
-                save_to_hour_file(path_ext, filename_ext,
-                                  tindex[secondhour_start:],
-                                  samples[secondhour_start:])
-
+    if args.jobs > 1 and not args.dry_run:
+        failed = combine_parallel(myfiles, args.output_directory, args.jobs)
         if args.delete_files:
+            for filename in myfiles:
+                if filename not in failed:
+                    os.remove(filename)
+                    logging.debug("\t - removed " + filename)
+    else:
+        failed = set()
+        for i in np.arange(0, len(myfiles)):
+            print("Processing", myfiles[i])
+            combine_file(myfiles[i], args.output_directory, args.dry_run)
+
+            if args.delete_files:
+                if args.dry_run:
+                    print("Would remove"+myfiles[i])
+                else:
+                    os.remove(myfiles[i])
+                    logging.debug("\t - removed " + myfiles[i])
             if args.dry_run:
-                print("Would remove"+myfiles[i])
-            else:
-                os.remove(myfiles[i])
-                logging.debug("\t - removed " + myfiles[i])
-        if args.dry_run:
-            print("--")  # Just to provide a nicer output format...
+                print("--")  # Just to provide a nicer output format...
 
+    elapsed = time.monotonic()-started
+    print("Merged %d files in %.1fs (%.1f records/s), %d failed" %
+          (len(myfiles)-len(failed), elapsed,
+           (len(myfiles)-len(failed))/max(elapsed, 1e-9), len(failed)))
 
 if __name__ == "__main__":
     main()
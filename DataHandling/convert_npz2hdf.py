@@ -3,6 +3,20 @@
 Convert individual npz-datafiles to HDF5-format and add relevant
 metadata.
 
+The datasets are chunked by time windows (--chunk-seconds, one minute by
+default), so that reading a slice of the data decompresses only the
+chunks of that slice, and are compressed with gzip (--level) or lzf, or not
+at all (--compression), by default after the shuffle filter (which puts
+the bytes of the samples together by significance and makes them compress
+better and faster). The chunks are aligned with the time windows when the
+data starts at a full window, as the gap-filled hour files do.
+
+With --benchmark the file is written with each compression (with and
+without the shuffle filter, and as the old files were written) to a
+temporary directory instead, and the write time, the time to read random
+slices (--slice-seconds) and the compression ratio are printed:
+
+    convert_npz2hdf.py -i doppler_lyr_20240501_12UT-nogaps.npz --benchmark
 """
 
 import numpy as np
@@ -12,6 +26,10 @@ import argparse
 import os
 import datetime as dt
 import logging
+import shutil
+import tempfile
+import time
+from hourfile import read_hour
 # import pathlib
 
 
@@ -21,6 +39,28 @@ def parse_args():
     parser.add_argument("-v", "--verbose", action="store_true")
     # parser.add_argument("-d", "--delete-files", action="store_true")
     parser.add_argument("-i", "--input-file", required=True)
+    parser.add_argument("-c", "--compression", default="gzip",
+                        choices=COMPRESSIONS,
+                        help="Compression of the datasets "
+                        "(default: %(default)s)")
+    parser.add_argument("-l", "--level", type=int, default=4,
+                        help="Level of the gzip compression, 0-9 "
+                        "(default: %(default)s)")
+    parser.add_argument("--no-shuffle", dest="shuffle", action="store_false",
+                        help="Do not use the shuffle filter")
+    parser.add_argument("--chunk-seconds", type=float, default=60,
+                        help="Length of the chunks (default: %(default)s)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Compare the compressions instead")
+    parser.add_argument("--slice-seconds", type=float, default=600,
+                        help="Length of the slices read in the benchmark "
+                        "(default: %(default)s)")
+    parser.add_argument("--reads", type=int, default=20,
+                        help="Number of slices read in the benchmark "
+                        "(default: %(default)s)")
+    parser.add_argument("--benchmark-directory",
+                        help="Where to write the benchmark files "
+                        "(default: a temporary directory)")
 #    parser.add_argument("-o", "--output-directory",
 #                    default="/dev/shm/Doppler")
 #    parser.add_argument("-i", "--input-file",
@@ -31,15 +71,77 @@ def parse_args():
     return parser.parse_args()
 
 
-def savetoHDF5(filename):
-    mydata = np.load(filename)
-    ts = mydata["timestamps"]
-    iqdata = mydata["iq"]
+COMPRESSIONS = ("gzip", "lzf", "none")
+
+
+def read_sorted(filename):
+    """The time stamps, the samples and the sample rate of an hour file
+
+    The samples are sorted into sequential order.
+    """
+    data = read_hour(filename)
+    ts = data.timestamps
+    iqdata = data.iq
 
     # Sort the data into sequential order
-    i = np.argsort(ts)
-    ts = ts[i]
-    iqdata = iqdata[i]
+    i = np.argsort(ts, kind="stable")
+    return ts[i], iqdata[..., i], data.fs
+
+
+def chunk_shape(shape, fs, chunk_seconds):
+    """The chunks of a dataset of shape, chunk_seconds of samples each"""
+    n = max(1, min(int(round(chunk_seconds*fs)), shape[-1]))
+    return tuple(shape[:-1])+(n,)
+
+
+def filter_options(compression, level=4, shuffle=True):
+    """The h5py keyword arguments of the compression"""
+    if compression == "none":
+        return {}
+    options = {"compression": compression, "shuffle": shuffle}
+    if compression == "gzip":
+        options["compression_opts"] = level
+    return options
+
+
+def write_hdf5(hdffilename, ts, iqdata, fs, compression="gzip", level=4,
+               shuffle=True, chunk_seconds=60, auto_chunks=False):
+    """Write the samples and the metadata into an HDF5-file
+
+    With auto_chunks h5py chooses the chunks (as the older files were
+    written).
+    """
+    options = filter_options(compression, level, shuffle)
+    if len(ts) == 0:
+        auto_chunks = True
+    with h5py.File(hdffilename, "w") as f:
+        dset = f.create_dataset("timestamps", data=ts, chunks=True if
+                                auto_chunks else
+                                chunk_shape(ts.shape, fs, chunk_seconds),
+                                **options)
+        dset.attrs["Description"] = np.bytes_(
+            "UNIX Time Stamp for each sample")
+
+        dset = f.create_dataset("IQ", data=iqdata, chunks=True if
+                                auto_chunks else
+                                chunk_shape(iqdata.shape, fs, chunk_seconds),
+                                **options)
+        dset.attrs["Description"] = np.bytes_("Individual samples")
+        dset.attrs["Sample rate"] = fs
+
+        dset = f.create_dataset("Station", data=h5py.Empty("f"))
+        dset.attrs["Name"] = np.bytes_("Longyearbyen")
+        dset.attrs["Institute"] = np.bytes_("University Centre in Svalbard")
+        dset.attrs["Location"] = np.bytes_("Kjell Henriksen Observatory")
+        dset.attrs["Receiver"] = np.bytes_("78.14798N 16.04235E")
+        dset.attrs["RX Frequency"] = np.bytes_("4450000-25")
+        dset.attrs["Transmitter"] = np.bytes_("77.00145N 15.54021E")
+        dset.attrs["TX Frequency"]=np.bytes_("4450000")
+
+
+def savetoHDF5(filename, compression="gzip", level=4, shuffle=True,
+               chunk_seconds=60):
+    ts, iqdata, fs = read_sorted(filename)
 
     starttime = dt.datetime.utcfromtimestamp(min(ts))
     stoptime = dt.datetime.utcfromtimestamp(max(ts))
@@ -53,22 +155,59 @@ def savetoHDF5(filename):
     pre,_=os.path.splitext(filename)
     hdffilename=pre+".hdf5"
     
-    with h5py.File(hdffilename, "w") as f:
-        dset = f.create_dataset("timestamps", data=ts, compression="gzip")
-        dset.attrs["Description"] = np.string_(
-            "UNIX Time Stamp for each sample")
+    write_hdf5(hdffilename, ts, iqdata, fs, compression, level, shuffle,
+               chunk_seconds)
 
-        dset = f.create_dataset("IQ", data=iqdata, compression="gzip")
-        dset.attrs["Description"] = np.string_("Individual samples")
 
-        dset = f.create_dataset("Station", data=h5py.Empty("f"))
-        dset.attrs["Name"] = np.string_("Longyearbyen")
-        dset.attrs["Institute"] = np.string_("University Centre in Svalbard")
-        dset.attrs["Location"] = np.string_("Kjell Henriksen Observatory")
-        dset.attrs["Receiver"] = np.string_("78.14798N 16.04235E")
-        dset.attrs["RX Frequency"] = np.string_("4450000-25")
-        dset.attrs["Transmitter"] = np.string_("77.00145N 15.54021E")
-        dset.attrs["TX Frequency"]=np.string_("4450000")
+def read_slices(hdffilename, fs, slice_seconds, reads, seed=0):
+    """Mean time (s) to read random slices of the time stamps and samples"""
+    rng = np.random.default_rng(seed)
+    elapsed = 0.0
+    with h5py.File(hdffilename, "r") as f:
+        n = f["IQ"].shape[-1]
+        m = min(int(round(slice_seconds*fs)), n)
+        for a in rng.integers(0, n-m+1, size=reads):
+            started = time.perf_counter()
+            f["timestamps"][a:a+m]
+            f["IQ"][..., a:a+m]
+            elapsed += time.perf_counter()-started
+    return elapsed/max(reads, 1)
+
+
+def benchmark(filename, chunk_seconds=60, slice_seconds=600, reads=20,
+              directory=None):
+    """Write the file with each compression and print the timings"""
+    ts, iqdata, fs = read_sorted(filename)
+    raw = ts.nbytes+iqdata.nbytes
+    layouts = [("gzip 4, auto chunks (old)", ("gzip", 4, False), True)]
+    for compression, level in (("none", 0), ("lzf", 0), ("gzip", 1),
+                               ("gzip", 4), ("gzip", 9)):
+        for shuffle in (False, True) if compression != "none" else (False,):
+            name = compression if compression != "gzip" else \
+                "gzip %d" % level
+            if shuffle:
+                name += " + shuffle"
+            layouts.append((name, (compression, level, shuffle), False))
+    tmpdir = tempfile.mkdtemp(dir=directory)
+    print("File: %s, %d samples, %.1f MB, %gs chunks, %d reads of %gs" %
+          (filename, iqdata.shape[-1], raw/1e6, chunk_seconds, reads,
+           slice_seconds))
+    print("%-28s %9s %9s %7s" % ("Layout", "write (s)", "read (s)",
+                                 "ratio"))
+    try:
+        for i, (name, (compression, level, shuffle), auto) in \
+                enumerate(layouts):
+            hdffilename = os.path.join(tmpdir, "%02d.hdf5" % i)
+            started = time.perf_counter()
+            write_hdf5(hdffilename, ts, iqdata, fs, compression, level,
+                       shuffle, chunk_seconds, auto_chunks=auto)
+            written = time.perf_counter()-started
+            read = read_slices(hdffilename, fs, slice_seconds, reads)
+            ratio = raw/os.path.getsize(hdffilename)
+            print("%-28s %9.3f %9.4f %7.2f" % (name, written, read, ratio))
+            os.remove(hdffilename)
+    finally:
+        shutil.rmtree(tmpdir)
 
 def main():
     """ Process all individual datafiles into one-hour-files"""
@@ -76,7 +215,12 @@ def main():
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
         logging.debug("Verbose mode")
-    savetoHDF5(args.input_file)
+    if args.benchmark:
+        benchmark(args.input_file, args.chunk_seconds, args.slice_seconds,
+                  args.reads, args.benchmark_directory)
+    else:
+        savetoHDF5(args.input_file, args.compression, args.level,
+                   args.shuffle, args.chunk_seconds)
 
 
 if __name__ == "__main__":
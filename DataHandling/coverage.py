@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""
+Coverage of the hour files, and how much of a time range has data
+
+Next to each hour file (doppler_lyr_YYYYmmdd_HHUT.npz) there is a small
+JSON sidecar (doppler_lyr_YYYYmmdd_HHUT.coverage.json) with a bitmap of
+the samples of the hour that the file has, one bit per sample (10 ms at
+100 Hz), and the counts:
+
+    start       sample clock (index at fs since 1970) of the start of the hour
+    fs          sample rate (Hz)
+    expected    samples in the hour
+    covered     samples in the file
+    runs        runs of consecutive samples
+    first, last sample clock of the first sample and after the last one
+    bitmap      np.packbits() of the bitmap, zlib-compressed, base64
+
+The combiner writes the sidecar whenever it merges data into an hour file
+and the gap filler writes one for each -nogaps file (from its mask of
+valid samples), so whether an hour is complete is known from a file of a
+few kilobytes, without reading the samples. The samples that the receiver
+filled with zeros (the gap table of a record) are not merged into the hour
+files, so they are not covered and are listed with the other gaps.
+
+The script tells how much of the days from start to end has data and
+lists the gaps:
+
+    coverage.py -r /home/aurora/Data -s 2024-05-01 -e 2024-05-31 --gaps
+
+An hour file without an up-to-date sidecar is read (its spans only, see
+hourfile.py), and with --update the sidecar is written for it.
+"""
+
+import argparse
+import base64
+import datetime as dt
+import json
+import os
+import re
+import zlib
+import numpy as np
+from hourfile import merge_spans, read_spans
+
+
+def coverage_name(filename):
+    """Name of the coverage sidecar of an hour file"""
+    return os.path.splitext(filename)[0]+".coverage.json"
+
+
+def spans_bitmap(spans, start, nsamples):
+    """Bitmap of the samples start:start+nsamples that are in the spans"""
+    bitmap = np.zeros(nsamples, dtype=bool)
+    for a, b in spans:
+        bitmap[max(a-start, 0):max(min(b-start, nsamples), 0)] = True
+    return bitmap
+
+
+def bitmap_spans(bitmap):
+    """The runs of True in the bitmap as (start, stop) spans"""
+    edges = np.diff(bitmap.astype(np.int8), prepend=0, append=0)
+    return np.column_stack((np.nonzero(edges == 1)[0],
+                            np.nonzero(edges == -1)[0]))
+
+
+def coverage_info(bitmap, start, fs, spans=None):
+    """The sidecar contents (a dictionary) of a bitmap of an hour
+
+    spans are the runs of the bitmap (sample clock), if known already.
+    """
+    if spans is None:
+        spans = bitmap_spans(bitmap) + start
+    return {"start": int(start), "fs": float(fs),
+            "expected": len(bitmap),
+            "covered": int(np.count_nonzero(bitmap)),
+            "runs": len(spans),
+            "first": int(spans[0, 0]) if len(spans) else None,
+            "last": int(spans[-1, 1]) if len(spans) else None,
+            "bitmap": base64.b64encode(
+                zlib.compress(np.packbits(bitmap).tobytes())).decode()}
+
+
+def write_coverage(filename, start, fs, spans=None, bitmap=None):
+    """Write the coverage sidecar of an hour file
+
+    start is the sample clock of the start of the hour. The samples in the
+    file are given as merged spans or as a bitmap of the hour.
+    """
+    if bitmap is None:
+        nsamples = int(round(3600*fs))
+        bitmap = spans_bitmap(spans, start, nsamples)
+        spans = np.clip(spans, start, start+nsamples)
+        spans = spans[spans[:, 1] > spans[:, 0]]
+    info = coverage_info(bitmap, start, fs, spans)
+    name = coverage_name(filename)
+    with open(name+".tmp", "w") as f:
+        json.dump(info, f)
+    os.replace(name+".tmp", name)
+    return info
+
+
+def read_coverage(filename):
+    """The coverage sidecar of an hour file (None if there is none)
+
+    The bitmap is unpacked to a bool array.
+    """
+    try:
+        with open(coverage_name(filename)) as f:
+            info = json.load(f)
+    except FileNotFoundError:
+        return None
+    packed = np.frombuffer(zlib.decompress(base64.b64decode(info["bitmap"])),
+                           dtype=np.uint8)
+    info["bitmap"] = np.unpackbits(packed, count=info["expected"]).astype(bool)
+    return info
+
+
+def hour_coverage(filename, update=False, hour=None):
+    """The coverage of an hour file, from the sidecar if it is up to date
+
+    hour is the hour of the file (since 1970), from the file name by
+    default.
+    """
+    name = coverage_name(filename)
+    if os.path.exists(name) and \
+            os.path.getmtime(name) >= os.path.getmtime(filename):
+        return read_coverage(filename)
+    if hour is None:
+        hour = filename_hour(filename)
+    fs, spans = read_spans(filename)
+    per_hour = int(round(3600*fs))
+    start = hour*per_hour
+    bitmap = spans_bitmap(merge_spans(spans), start, per_hour)
+    if update:
+        write_coverage(filename, start, fs, bitmap=bitmap)
+    info = coverage_info(bitmap, start, fs)
+    info["bitmap"] = bitmap
+    return info
+
+
+def hour_filename(root, hour):
+    """Name of the hour file of the hour (since 1970) in the archive"""
+    hourtime = dt.datetime.utcfromtimestamp(hour*3600)
+    return os.path.join(root, hourtime.strftime("%Y"), hourtime.strftime("%m"),
+                        hourtime.strftime("%d"),
+                        hourtime.strftime("doppler_lyr_%Y%m%d_%HUT.npz"))
+
+
+def filename_hour(filename):
+    """The hour (since 1970) of an hour file from its name"""
+    match = re.search(r"doppler_lyr_(\d{8}_\d{2})UT",
+                      os.path.basename(filename))
+    if match is None:
+        raise ValueError("No hour in the file name " + filename)
+    hourtime = dt.datetime.strptime(match.group(1), "%Y%m%d_%H").replace(
+        tzinfo=dt.timezone.utc)
+    return int(hourtime.timestamp())//3600
+
+
+def range_coverage(root, start, end, update=False):
+    """The coverage of the days start to end (dates)
+
+    Returns the number of hours, the hours with a file, the complete hours,
+    the covered seconds and the gaps as (start, stop) unix times.
+    """
+    first = int(dt.datetime(start.year, start.month, start.day,
+                            tzinfo=dt.timezone.utc).timestamp())//3600
+    last = int(dt.datetime(end.year, end.month, end.day,
+                           tzinfo=dt.timezone.utc).timestamp())//3600+24
+    found = complete = 0
+    seconds = 0.0
+    gaps = []
+    for hour in range(first, last):
+        filename = hour_filename(root, hour)
+        if not os.path.exists(filename):
+            gaps.append((hour*3600.0, (hour+1)*3600.0))
+            continue
+        info = hour_coverage(filename, update, hour)
+        found += 1
+        fs = info["fs"]
+        seconds += info["covered"]/fs
+        if info["covered"] == info["expected"]:
+            complete += 1
+            continue
+        for a, b in bitmap_spans(~info["bitmap"]):
+            gaps.append(((info["start"]+a)/fs, (info["start"]+b)/fs))
+    # Join the gaps over the hour edges
+    joined = []
+    for a, b in gaps:
+        if joined and a-joined[-1][1] < 1e-6:
+            joined[-1] = (joined[-1][0], b)
+        else:
+            joined.append((a, b))
+    return last-first, found, complete, seconds, joined
+
+
+def format_time(t):
+    text = dt.datetime.utcfromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S.%f")
+    return text[:-4]
+
+
+def parse_date(text):
+    return dt.datetime.strptime(text, "%Y-%m-%d").date()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="How much of the days has data, and where the gaps are")
+    parser.add_argument("-r", "--root-directory", default="/home/aurora/Data",
+                        help="Root of the archive (default: %(default)s)")
+    parser.add_argument("-s", "--start", type=parse_date, required=True,
+                        help="First day (YYYY-mm-dd)")
+    parser.add_argument("-e", "--end", type=parse_date,
+                        help="Last day (YYYY-mm-dd, default: the first day)")
+    parser.add_argument("-g", "--gaps", action="store_true",
+                        help="List the gaps")
+    parser.add_argument("-m", "--min-gap", type=float, default=0,
+                        help="List only the gaps of at least this many "
+                        "seconds")
+    parser.add_argument("-u", "--update", action="store_true",
+                        help="Write the missing or old sidecars")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    end = args.start if args.end is None else args.end
+    hours, found, complete, seconds, gaps = range_coverage(
+        args.root_directory, args.start, end, args.update)
+    print("%s - %s: %.2f%% covered, %d hours, %d with data, %d complete, "
+          "%d gaps" % (args.start, end, 100*seconds/(hours*3600), hours,
+                       found, complete, len(gaps)))
+    if args.gaps:
+        for a, b in gaps:
+            if b-a >= args.min_gap:
+                print("%s - %s  %10.2fs" % (format_time(a), format_time(b),
+                                            b-a))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""
+Record files of the Doppler receiver (*.dope)
+
+One record holds the decimated IQ-samples of one minute (or less, after
+a restart) for one or more channels. The file starts with a fixed-size
+header (HEADER_SIZE bytes, little-endian) that describes the record, so
+the record can be inspected by reading the header only:
+
+    magic "DOPE", format version, header size, flags
+    start_count   sample counter (at rx_rate, since 1970) of the first sample
+    rx_rate       sample rate of the USRP (Hz)
+    factor        decimation factor, fs = rx_rate/factor
+    fs            sample rate of the record (Hz)
+    nsamples      samples per channel
+    channels      USRP channels (up to 8)
+    freq, gain    tuning frequency (Hz) and gain (dB) of the receiver
+    ngaps         entries in the gap table
+    lost_samples  samples lost (at rx_rate) in the gaps
+    payload_size  bytes after the header
+    payload_crc   CRC-32 of the bytes after the header
+    created       when the file was written (unix time)
+    header_crc    CRC-32 of the header before this field
+
+After the header comes the gap table, ngaps (sample counter, number of
+samples) pairs as int64, of the samples lost at the receiver and replaced
+with zeros, and then the samples as complex64 (channels, nsamples),
+zlib-compressed if the FLAG_ZLIB flag is set.
+
+The script prints the headers of the given files:
+
+    dopplerrecord.py {filename.dope} [filename2.dope] [...]
+"""
+
+import datetime as dt
+import os
+import struct
+import sys
+import time
+import zlib
+import numpy as np
+
+MAGIC = b"DOPE"
+VERSION = 1
+HEADER_SIZE = 256
+FLAG_ZLIB = 1
+MAX_CHANNELS = 8
+
+_FIELDS = struct.Struct("<4sHHIqdIdIH8sddIQQId")
+_FIELD_NAMES = ("magic", "version", "header_size", "flags", "start_count",
+                "rx_rate", "factor", "fs", "nsamples", "nchannels",
+                "channels", "freq", "gain", "ngaps", "lost_samples",
+                "payload_size", "payload_crc", "created")
+
+
+class RecordError(ValueError):
+    """The file is not a valid record"""
+    pass
+
+
+def write_record(filename, samples, start_count, rx_rate, factor,
+                 channels, freq, gain, gaps=(), compress=False):
+    """Write the samples (channels, nsamples) and their description
+
+    The file is written under a temporary name and renamed when complete,
+    so that readers never see a partial record.
+    """
+    samples = np.ascontiguousarray(samples, dtype="<c8")
+    if samples.ndim == 1:
+        samples = samples.reshape(1, -1)
+    if len(channels) != samples.shape[0] or len(channels) > MAX_CHANNELS:
+        raise ValueError("Bad number of channels %d" % len(channels))
+    gaps = np.array(gaps, dtype="<i8").reshape(-1, 2)
+    data = samples.tobytes()
+    flags = 0
+    if compress:
+        data = zlib.compress(data, 1)
+        flags |= FLAG_ZLIB
+    payload = gaps.tobytes()+data
+    fields = _FIELDS.pack(MAGIC, VERSION, HEADER_SIZE, flags,
+                          int(start_count), rx_rate, int(factor),
+                          rx_rate/factor, samples.shape[1], len(channels),
+                          bytes(channels), freq, gain, gaps.shape[0],
+                          int(gaps[:, 1].sum()), len(payload),
+                          zlib.crc32(payload), time.time())
+    header = fields.ljust(HEADER_SIZE-4, b"\0")
+    header += struct.pack("<I", zlib.crc32(header))
+    with open(filename+".tmp", "wb") as f:
+        f.write(header)
+        f.write(payload)
+    os.replace(filename+".tmp", filename)
+
+
+def _parse_header(header):
+    """Header fields from the first HEADER_SIZE bytes of a record"""
+    if len(header) < HEADER_SIZE or header[0:4] != MAGIC:
+        raise RecordError("Not a record file")
+    (crc,) = struct.unpack("<I", header[HEADER_SIZE-4:HEADER_SIZE])
+    if zlib.crc32(header[0:HEADER_SIZE-4]) != crc:
+        raise RecordError("Bad header checksum")
+    info = dict(zip(_FIELD_NAMES, _FIELDS.unpack_from(header)))
+    if info["version"] > VERSION:
+        raise RecordError("Unknown record version %d" % info["version"])
+    info["channels"] = list(info["channels"][0:info["nchannels"]])
+    info["timestamp"] = info["start_count"]/info["rx_rate"]
+    return info
+
+
+def read_header(filename):
+    """Read the header of a record (a dictionary of the fields)"""
+    with open(filename, "rb") as f:
+        return _parse_header(f.read(HEADER_SIZE))
+
+
+def read_record(filename, verify=True):
+    """Read a record, returns the header, the samples and the gap table
+
+    The samples are (channels, nsamples) complex64 and the gap table
+    (ngaps, 2) int64. With verify the payload checksum is checked.
+    """
+    with open(filename, "rb") as f:
+        info = _parse_header(f.read(HEADER_SIZE))
+        f.seek(info["header_size"])
+        payload = f.read(info["payload_size"])
+    if len(payload) != info["payload_size"]:
+        raise RecordError("Truncated record")
+    if verify and zlib.crc32(payload) != info["payload_crc"]:
+        raise RecordError("Bad payload checksum")
+    ngaps = info["ngaps"]
+    gaps = np.frombuffer(payload, dtype="<i8", count=2*ngaps).reshape(-1, 2)
+    data = payload[16*ngaps:]
+    if info["flags"] & FLAG_ZLIB:
+        data = zlib.decompress(data)
+    samples = np.frombuffer(data, dtype="<c8").reshape(info["nchannels"],
+                                                      info["nsamples"])
+    return info, samples, gaps
+
+
+def load_samples(filename):
+    """Timestamp, fs and samples of a record or a legacy npz file
+
+    The samples of a single channel are returned as a flat array as in
+    the npz files.
+    """
+    if filename.endswith(".npz"):
+        data = np.load(filename)
+        return float(data["timestamp"]), float(data["fs"]), data["samples"]
+    info, samples, gaps = read_record(filename)
+    if samples.shape[0] == 1:
+        samples = samples[0]
+    return info["timestamp"], info["fs"], samples
+
+
+def main():
+    if len(sys.argv) == 1:
+        print("dopplerrecord.py {filename.dope} [filename2.dope] [...]")
+        sys.exit()
+    for thisfile in sys.argv[1:]:
+        print(thisfile)
+        try:
+            info = read_header(thisfile)
+        except (OSError, RecordError) as e:
+            print("\t" + str(e))
+            continue
+        start = dt.datetime.fromtimestamp(info["timestamp"],
+                                          tz=dt.timezone.utc)
+        print("\tversion %d, %d samples x %d channels %s at %gHz" %
+              (info["version"], info["nsamples"], info["nchannels"],
+               info["channels"], info["fs"]))
+        print("\tFrom: %s (sample %d at %gHz)" % (start, info["start_count"],
+                                                  info["rx_rate"]))
+        print("\tfreq %.1fHz, gain %gdB" % (info["freq"], info["gain"]))
+        print("\t%d gaps, %d samples lost" % (info["ngaps"],
+                                              info["lost_samples"]))
+
+
+if __name__ == "__main__":
+    main()
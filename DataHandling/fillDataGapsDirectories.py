@@ -7,108 +7,146 @@ Created on Thu Jan  4 11:30:11 2024
 
 The streaming of IQ-data from the USRP does not always work perfectly
 and there are small random gaps in data. The missing IQ-samples are
-often replaced with zeros in software radio setups. It would be better to do
-this at the higher sampling rate (200kHz with N200's) but this is probably
-something that requires switching from python to C in order to do it in realtime.
-Something to figure out later...
+often replaced with zeros in software radio setups. The receiver
+(Tests/streaming_test2.py) now does this at the full sampling rate: it
+follows the sample counter of the USRP and writes zeros for the missing
+packets before decimating, so new records are already on the nominal
+time grid. This script is still needed for older data and for the gaps
+between records (e.g. after a restart of the receiver).
 
 This short script reads in raw data in npz-format, extents the time range
-to cover a full hour and then inter/extrapolates new IQ-values to a perfect
-nominal temporal resolution as if no samples were missed.
+to cover a full hour and then puts the IQ-values on a perfect nominal
+temporal resolution as if no samples were missed (see gapfill.py).
 
-This script goes through the data directory covering several months of data
-and zero-fills all gaps in *.npz file. In other words, if the value is zero,
-there is no data.
+This script goes through the hour files of the archive (ROOT/YYYY/MM/DD/)
+from the start date to the end date and zero-fills all gaps in each *.npz
+file. In other words, if the value is zero, there is no data. The files
+are processed by a pool of processes (-j, one per core by default). A file
+whose -nogaps file is up to date (newer than the file, or with --check hash
+made from the same data) is skipped, unless --force is given. A file that
+cannot be processed is reported and written to the --failures file, and
+the rest are processed anyway.
+
+    fillDataGapsDirectories.py -r /home/aurora/Data -s 2024-01-01 -e 2024-06-30
 
 TODO: make this script produce properly formatted HDF5-files
 
 """
 
-import numpy as np
 import argparse
+import concurrent.futures
 import datetime as dt
-import pytz
-from scipy import interpolate
-import os
-#import sys
 import glob
+import logging
+import os
+import sys
+import time
+from gapfill import CONFLICTS, TOLERANCE, fill_file, nogaps_name, up_to_date
 
-def parse_args():
-    parser = argparse.ArgumentParser(description="Test spectrogram")
-    parser.add_argument("-i", "--input-file", type=str,
-                        required=True, help="Input file (NumPy data)")
 
+def parse_date(text):
+    return dt.datetime.strptime(text, "%Y-%m-%d").date()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Fill the gaps of the hour files of a date range")
+    parser.add_argument("-r", "--root-directory", default="/home/aurora/Data",
+                        help="Root of the archive (default: %(default)s)")
+    parser.add_argument("-s", "--start", type=parse_date, required=True,
+                        help="First day (YYYY-mm-dd)")
+    parser.add_argument("-e", "--end", type=parse_date,
+                        help="Last day (YYYY-mm-dd, default: the first day)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Number of processes (default: %(default)s)")
+    parser.add_argument("--check", choices=("mtime", "hash"),
+                        default="mtime",
+                        help="How to tell that a -nogaps file is up to date "
+                        "(default: %(default)s)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Process also the files that are up to date")
+    parser.add_argument("--failures",
+                        help="File to write the names of the failed files to")
+    parser.add_argument("-t", "--tolerance", type=float, default=TOLERANCE,
+                        help="Largest offset of a sample from the nominal "
+                        "sample grid (in samples) (default: %(default)s)")
+    parser.add_argument("-c", "--conflict", choices=CONFLICTS,
+                        default="first",
+                        help="Which sample to keep when several are on the "
+                        "same grid position (default: %(default)s)")
+    parser.add_argument("-v", "--verbose", action="store_true")
     return parser.parse_args()
 
-def processOneFile(filename):
-    print(filename)
-    mydata = np.load(filename)
-    ts = mydata["timestamps"]
-    iq = mydata["iq"]
-
-    # Sort the incoming data based on the timestamps
-    ind = np.argsort(ts)
-    ts_sorted = ts[ind]
-    iq_sorted = iq[ind]
-
-    utctz=pytz.timezone(('UTC')) # To avoid weird things..
-
-    ts_min=np.min(ts_sorted)
-    ts_max=np.max(ts_sorted)
-
-    data_start=dt.datetime.fromtimestamp(ts_min,tz=utctz)
-    data_end=dt.datetime.fromtimestamp(ts_max,tz=utctz)
-
-    if data_end-data_start>dt.timedelta(hours=1):
-        print('The data covers more than one hour, which should not happen!')
-        print('Exiting...')
-        exit()
-
-    newdata_start=data_start.replace(minute=0,second=0,microsecond=0)
-    newdata_end=newdata_start+dt.timedelta(hours=1)
-    newts_min=newdata_start.timestamp()
-    newts_max=newdata_end.timestamp()
-
-    print('\t',newdata_start,'\t',newdata_end)
-
-    # The nominal sampling frequency is 100Hz
-    # - form a "perfect" timestamp vector
-    # - inter/extrapolate new complex sample values
-    # - fill missing sample instants with "zeros"
-    fs=100
-    delta_t=1/fs
-    new_ts=np.arange(newts_min,newts_max,step=delta_t)
-    f=interpolate.interp1d(ts_sorted,iq_sorted,fill_value=0, bounds_error=False)
-    new_iq=f(new_ts)
-    # Store the interpolated data with a slightly modified name
-    # into the same directory as the original file
-    outpath=os.path.split(filename)[0]
-    basename=os.path.basename(filename)
-    newname=os.path.splitext(basename)[0]+'-nogaps.npz'
-    outfile=os.path.join(outpath,newname)
-
-    print('\t -> ', outfile)
-    np.savez(outfile,timestamps=new_ts,iq=new_iq)
-
-
-# def main(filelist):
-#     for filename in filelist:
-
-
-# if __name__ == "__main__":
-#     if len(sys.argv) == 1:
-#         print("fillDataGaps.py {filename.npz} [filename2.npz] [...]")
-#         sys.exit()
-#     main(sys.argv[1:])
-
-basedir=os.path.join('t:\\','PRIDE')
-year=2024
-for month in (1,2,3,4,5,6):
-    for day in np.arange(1,32):
-        daydir=os.path.join(basedir,f'{year:04}',f'{month:02}',f'{day:02}')
-        datafiles=glob.glob(os.path.join(daydir,'*.npz'))
-        for onefile in datafiles:
-            processOneFile(onefile)
-# datafiles=glob.glob('*.npz')
-# for onefile in datafiles:
-#     processOneFile(onefile)
\ No newline at end of file
+
+def hour_files(root, start, end):
+    """The hour files of the days from start to end, in order"""
+    files = []
+    day = start
+    while day <= end:
+        daydir = os.path.join(root, "%04d" % day.year, "%02d" % day.month,
+                              "%02d" % day.day)
+        files += sorted(f for f in glob.glob(os.path.join(daydir, "*.npz"))
+                        if not f.endswith("-nogaps.npz"))
+        day += dt.timedelta(days=1)
+    return files
+
+
+def processOneFile(filename, check="mtime", force=False, tolerance=TOLERANCE,
+                   conflict="first"):
+    """Fill the gaps of one file unless it is up to date
+
+    Returns the counts of fill_grid(), or None if the file was skipped.
+    """
+    if not force and up_to_date(filename, nogaps_name(filename), check):
+        return None
+    outfile, stats = fill_file(filename, tolerance=tolerance,
+                               conflict=conflict)
+    return stats
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else
+                        logging.INFO)
+    end = args.start if args.end is None else args.end
+    files = hour_files(args.root_directory, args.start, end)
+    logging.info("%d hour files from %s to %s" % (len(files), args.start,
+                                                   end))
+    started = time.monotonic()
+    done = 0
+    skipped = 0
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max(args.jobs, 1)) as pool:
+        futures = {pool.submit(processOneFile, filename, args.check,
+                               args.force, args.tolerance,
+                               args.conflict): filename
+                   for filename in files}
+        for future in concurrent.futures.as_completed(futures):
+            filename = futures[future]
+            try:
+                stats = future.result()
+            except Exception as e:
+                logging.error("Filling the gaps of %s failed: %r" %
+                              (filename, e))
+                failed.append(filename)
+                continue
+            if stats is None:
+                skipped += 1
+                logging.debug("%s is up to date" % filename)
+            else:
+                done += 1
+                logging.info("%s: %d samples, %d off the grid, %d outside "
+                             "the hour, %d conflicts" %
+                             (filename, stats["placed"], stats["off_grid"],
+                              stats["outside"], stats["conflicts"]))
+    if args.failures is not None:
+        with open(args.failures, "w") as f:
+            for filename in sorted(failed):
+                f.write(filename+"\n")
+    print("Filled %d files in %.1fs, %d up to date, %d failed" %
+          (done, time.monotonic()-started, skipped, len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
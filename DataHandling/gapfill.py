@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""
+Filling the gaps of the hour files with zeros
+
+The samples of an hour file are put on the nominal sample grid of the
+hour, one array of zeros with the samples scattered in at their grid
+positions, and a mask of the grid positions that have a sample. The
+samples are not interpolated: a missing sample stays zero (and invalid in
+the mask), as is usual in software radio, instead of being a straight line
+between the samples on both sides of the gap.
+
+The samples of the newer files are on the sample clock already (see
+hourfile.py) and are copied in as they are. The older files have a float
+time stamp per sample, which is rounded to the nearest grid position. The
+time stamps come from time.time() when the record was written, so the
+offset of a record from the grid can be anything up to half a sample, and
+by default (a tolerance of half a sample) every sample is kept. With a
+smaller tolerance a sample further off the grid is dropped, with a
+warning. When several samples land on the same position, conflict decides
+which one is kept ("first" or "last" in the order of the file, or their
+"mean").
+
+This takes O(n) time and memory; sorting the time stamps and interpolating
+over them took an order of magnitude more of both.
+
+The coverage sidecar of the gap-filled file (see coverage.py) is written
+from the mask.
+
+The gap-filled file has the SHA-256 of the hour file it was made from
+("source_sha256"), so that it can be told whether it is up to date even
+when the modification times of the files are not to be trusted (e.g.
+after copying).
+"""
+
+import hashlib
+import logging
+import os
+import numpy as np
+from coverage import write_coverage
+from hourfile import read_hour, write_hour
+
+CONFLICTS = ("first", "last", "mean")
+TOLERANCE = 0.5     # samples, i.e. round to the nearest grid position
+
+
+def _grid_positions(span, ts, fs, start, tolerance):
+    """Grid positions of the samples of a chunk and which ones to keep"""
+    if ts is None:
+        return np.arange(span[0]-start, span[1]-start, dtype=np.int64), None
+    pos = ts*fs
+    pos -= start
+    index = np.rint(pos).astype(np.int64)
+    pos -= index
+    np.abs(pos, out=pos)
+    return index, pos <= tolerance
+
+
+def _join(arrays):
+    return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+
+def fill_grid(data, start, nsamples, tolerance=TOLERANCE, conflict="first"):
+    """Put the samples of an hour file (HourData) on the sample grid
+
+    The grid starts at the sample clock start and has nsamples samples at
+    data.fs. Returns the samples (complex64, zero where there is no
+    sample), the validity mask and a dictionary of counts of the samples:
+    "placed" on the grid, "off_grid" (dropped, off by more than tolerance
+    samples), "outside" the grid and "conflicts" (samples on a position
+    that already had one, combined with it as conflict says).
+    """
+    if conflict not in CONFLICTS:
+        raise ValueError("Unknown conflict handling " + conflict)
+    if data.iq is None:
+        raise ValueError("The samples of the hour file were not read")
+    if not data.chunks:
+        return (np.zeros(nsamples, dtype=np.complex64),
+                np.zeros(nsamples, dtype=bool),
+                {"placed": 0, "off_grid": 0, "outside": 0, "conflicts": 0})
+    index = []
+    keep = []
+    for span, ts, iq in data.chunks:
+        i, k = _grid_positions(span, ts, data.fs, start, tolerance)
+        index.append(i)
+        keep.append(np.ones(len(i), dtype=bool) if k is None else k)
+    index = _join(index)
+    keep = _join(keep)
+    off_grid = len(keep)-np.count_nonzero(keep)
+    # The negative positions are above nsamples as unsigned
+    inside = index.view(np.uint64) < nsamples
+    outside = np.count_nonzero(keep) - np.count_nonzero(keep & inside)
+    keep &= inside
+    if off_grid == 0 and outside == 0:
+        samples = data.iq
+        index_kept = index
+    else:
+        order = np.nonzero(keep)[0]
+        samples = data.iq[..., order]
+        index_kept = index[order]
+    counts = np.bincount(index_kept, minlength=nsamples)
+    valid = counts > 0
+    out = np.zeros(data.iq.shape[:-1]+(nsamples,), dtype=np.complex64)
+    conflicts = len(index_kept)-np.count_nonzero(valid)
+    if conflicts == 0 or conflict == "last":
+        # With repeated positions the last assignment wins
+        out[..., index_kept] = samples
+    elif conflict == "first":
+        out[..., index_kept[::-1]] = samples[..., ::-1]
+    else:
+        for c in np.ndindex(samples.shape[:-1]):
+            out[c] = (np.bincount(index_kept, samples[c].real, nsamples) +
+                      1j*np.bincount(index_kept, samples[c].imag, nsamples))
+        out[..., valid] /= counts[valid]
+    stats = {"placed": int(np.count_nonzero(valid)),
+             "off_grid": int(off_grid), "outside": int(outside),
+             "conflicts": int(conflicts)}
+    return out, valid, stats
+
+
+def nogaps_name(filename):
+    """Name of the gap-filled file of an hour file, in the same directory"""
+    return os.path.splitext(filename)[0]+"-nogaps.npz"
+
+
+def file_hash(filename):
+    """SHA-256 of the file as a hex string"""
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def up_to_date(filename, outfile, check="mtime"):
+    """Whether the gap-filled outfile is up to date with the hour file
+
+    check is "mtime" (outfile is not older than filename) or "hash" (the
+    source_sha256 of outfile is the hash of filename).
+    """
+    if not os.path.exists(outfile):
+        return False
+    if check == "mtime":
+        return os.path.getmtime(outfile) >= os.path.getmtime(filename)
+    try:
+        with np.load(outfile) as data:
+            if "source_sha256" not in data.files:
+                return False
+            source = str(data["source_sha256"])
+    except (OSError, ValueError):
+        return False
+    return source == file_hash(filename)
+
+
+def fill_file(filename, outfile=None, tolerance=TOLERANCE,
+              conflict="first"):
+    """Fill the gaps of an hour file, to nogaps_name(filename) by default
+
+    The output covers the whole hour of the first sample. Returns the name
+    of the output file and the counts of fill_grid().
+    """
+    if outfile is None:
+        outfile = nogaps_name(filename)
+    source = file_hash(filename)
+    data = read_hour(filename)
+    if len(data.spans) == 0:
+        raise ValueError("No samples in " + filename)
+    nsamples = int(round(3600*data.fs))
+    start = data.spans[0, 0]//nsamples*nsamples
+    iq, valid, stats = fill_grid(data, start, nsamples, tolerance, conflict)
+    if stats["off_grid"] or stats["outside"]:
+        logging.warning("%s: %d samples dropped, %d more than %g samples off "
+                        "the grid and %d outside the hour" %
+                        (filename, stats["off_grid"]+stats["outside"],
+                         stats["off_grid"], tolerance, stats["outside"]))
+    write_hour(outfile, iq, int(start), data.fs, valid=valid,
+               source_sha256=np.array(source))
+    write_coverage(outfile, int(start), data.fs, bitmap=valid)
+    return outfile, stats
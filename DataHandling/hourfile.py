@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""
+One-hour data files (doppler_lyr_YYYYmmdd_HHUT.npz)
+
+An hour file is a NumPy npz file (a zip archive) with the IQ-samples and
+their times. The times are kept on the integer sample clock: the sample
+index counts the samples at the sample rate "fs" from 1970, so the time of
+a sample is index/fs. The samples are stored in chunks, "iq_0000",
+"iq_0001" and so on, one per merge (e.g. per minute record), in the order
+they were added, each with its span of the sample clock, "span_0000" =
+[start, stop). The samples of a chunk are consecutive, so the spans are a
+run-length table of the time axis and there is no time stamp per sample
+(which took as much space as the samples themselves).
+
+A chunk is added to the end of the zip archive without touching the
+earlier ones, so adding a minute costs the same whatever the size of the
+file; rewriting the whole hour on each merge made the merging of an hour
+O(n^2).
+
+Older files have a float time stamp per sample, as one array "timestamps"
+and "iq", or as chunks "timestamps_0000" and "iq_0000", and possibly no
+"fs". They are read as well.
+
+Samples of several channels are (channels, samples) and are joined along
+the last axis.
+
+A file with the gaps filled (see gapfill.py) has the samples of the whole
+hour as one chunk and the mask of the valid samples, "valid". Its spans
+are those of the valid samples, not of the whole hour.
+
+read_hour() reads either kind of file. The time stamps are only computed
+when they are used:
+
+    data = read_hour(filename)
+    data.iq, data.fs, data.spans     # the samples and the covered spans
+    data.timestamps                  # unix time of each sample (s)
+"""
+
+import os
+import zipfile
+import numpy as np
+
+# A fixed time for the zip entries, so that the same data gives the same
+# file
+_ZIP_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def _write_member(zf, name, array):
+    info = zipfile.ZipInfo(name + ".npy", date_time=_ZIP_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    with zf.open(info, "w", force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(array),
+                                  allow_pickle=False)
+
+
+def chunk_names(files, prefix="iq"):
+    """Names of the arrays in the file that hold prefix, in order"""
+    # The old single array ("iq") sorts before the chunks
+    return sorted(name for name in files
+                  if name == prefix or name.startswith(prefix+"_"))
+
+
+def append_hour(filename, samples, start, fs):
+    """Add consecutive samples to the hour file
+
+    start is the sample index of the first sample at the sample rate fs.
+    The file is created if it does not exist.
+    """
+    with zipfile.ZipFile(filename, "a", zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as zf:
+        files = [name[:-4] for name in zf.namelist()]
+        n = len(chunk_names(files))
+        if "fs" not in files:
+            _write_member(zf, "fs", np.float64(fs))
+        _write_member(zf, "iq_%04d" % n, samples)
+        _write_member(zf, "span_%04d" % n,
+                      np.array([start, start+samples.shape[-1]],
+                               dtype=np.int64))
+
+
+def write_hour(filename, samples, start, fs, **arrays):
+    """Write consecutive samples to a new hour file (replacing an old one)
+
+    The keyword arguments are written to the file as they are, e.g. valid,
+    the mask of the samples that are not fill.
+    """
+    if os.path.exists(filename+".tmp"):
+        os.remove(filename+".tmp")
+    append_hour(filename+".tmp", samples, start, fs)
+    if arrays:
+        with zipfile.ZipFile(filename+".tmp", "a", zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as zf:
+            for name, array in arrays.items():
+                _write_member(zf, name, array)
+    os.replace(filename+".tmp", filename)
+
+
+def merge_spans(spans):
+    """Sorted union of (start, stop) spans, without overlaps"""
+    spans = np.asarray(spans, dtype=np.int64).reshape(-1, 2)
+    if len(spans) == 0:
+        return spans
+    spans = spans[np.argsort(spans[:, 0], kind="stable")]
+    # A span starts a new run if it starts after all the earlier ones end
+    ends = np.maximum.accumulate(spans[:, 1])
+    first = np.ones(len(spans), dtype=bool)
+    first[1:] = spans[1:, 0] > ends[:-1]
+    starts = np.nonzero(first)[0]
+    last = np.append(starts[1:]-1, len(spans)-1)
+    return np.column_stack((spans[starts, 0], ends[last]))
+
+
+def index_spans(index):
+    """The runs of consecutive sample indices as (start, stop) spans"""
+    index = np.unique(index)
+    if len(index) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    breaks = np.nonzero(np.diff(index) != 1)[0]
+    return np.column_stack((index[np.append(0, breaks+1)],
+                            index[np.append(breaks, len(index)-1)]+1))
+
+
+def uncovered(start, stop, spans):
+    """The parts of start:stop that are not in the merged spans
+
+    Only the spans that overlap start:stop are looked at. Returns a list of
+    (start, stop).
+    """
+    i = np.searchsorted(spans[:, 1], start, side="right")
+    j = np.searchsorted(spans[:, 0], stop, side="left")
+    parts = []
+    for a, b in spans[i:j]:
+        if a > start:
+            parts.append((start, int(a)))
+        start = max(start, int(b))
+    if start < stop:
+        parts.append((start, stop))
+    return parts
+
+
+def _estimate_fs(timestamps):
+    """Nominal sample rate of float time stamps"""
+    return float(np.round(1/np.median(np.diff(np.sort(timestamps)))))
+
+
+def _read_chunks(data, fs, samples):
+    """The sample rate and (span, timestamps, iq) of the chunks
+
+    Each chunk has either a span or (the older chunks) time stamps.
+    """
+    chunks = []
+    for name in chunk_names(data.files):
+        suffix = name[len("iq"):]
+        iq = data[name] if samples else None
+        if "span"+suffix in data.files:
+            chunks.append((data["span"+suffix], None, iq))
+        else:
+            chunks.append((None, data["timestamps"+suffix], iq))
+    if "fs" in data.files:
+        fs = float(data["fs"])
+    elif fs is None:
+        fs = _estimate_fs(np.concatenate([ts for span, ts, iq in chunks]))
+    return fs, chunks
+
+
+class HourData:
+    """The samples of an hour file and their times
+
+    iq are the samples, fs the sample rate and spans the merged (start,
+    stop) spans of the sample clock that the file has samples for. index
+    (the sample clock of each sample) and timestamps (s) are computed when
+    first used. The samples are in the order they were added, which is
+    not necessarily the order of time for the older files. valid is the
+    mask of the valid samples of a gap-filled file (otherwise None), and
+    the spans of such a file are those of its valid samples.
+    """
+
+    def __init__(self, fs, chunks, valid=None):
+        self.fs = fs
+        self.chunks = chunks
+        self.valid = valid
+        self._index = None
+        self._timestamps = None
+        spans = [span.reshape(1, 2) if ts is None else
+                 index_spans(np.round(ts*fs).astype(np.int64))
+                 for span, ts, iq in chunks]
+        self.spans = merge_spans(np.concatenate(spans) if spans else [])
+        if valid is not None:
+            self.spans = index_spans(self.index[valid])
+        self.iq = None
+        if chunks and chunks[0][2] is not None:
+            self.iq = np.concatenate([iq for span, ts, iq in chunks],
+                                     axis=-1)
+
+    @property
+    def index(self):
+        """The sample clock (sample index at fs from 1970) of the samples"""
+        if self._index is None:
+            self._index = np.concatenate(
+                [np.arange(span[0], span[1], dtype=np.int64)
+                 if ts is None else np.round(ts*self.fs).astype(np.int64)
+                 for span, ts, iq in self.chunks] or [[]]).astype(np.int64)
+        return self._index
+
+    @property
+    def timestamps(self):
+        """The unix time of the samples (s)"""
+        if self._timestamps is None:
+            self._timestamps = np.concatenate(
+                [np.arange(span[0], span[1], dtype=np.int64)/self.fs
+                 if ts is None else ts for span, ts, iq in self.chunks] or
+                [[]])
+        return self._timestamps
+
+    def missing(self, start, stop):
+        """The spans of the sample clock in start:stop without samples"""
+        return uncovered(start, stop, self.spans)
+
+
+def read_hour(filename, samples=True, fs=None):
+    """Read an hour file (HourData), without the samples if not samples
+
+    fs is the sample rate of an older file without it (by default the
+    rate is found from the time stamps).
+    """
+    with np.load(filename) as data:
+        fs, chunks = _read_chunks(data, fs, samples)
+        valid = data["valid"] if "valid" in data.files else None
+    return HourData(fs, chunks, valid)
+
+
+def read_spans(filename, fs=None):
+    """The sample rate and the merged spans of the samples of an hour file
+
+    Only the spans are read, and the time stamps of the older chunks.
+    """
+    data = read_hour(filename, samples=False, fs=fs)
+    return data.fs, data.spans
@@ -3,12 +3,14 @@
 """
 A quick script to check what one or more npz-files contain.
 Essentially prints out the array names and the array sizes in each npz-file
+(the hour files can have the data in several chunks, see hourfile.py)
 """
 
 import sys
 import numpy as np
 import datetime as dt
 import pytz
+from hourfile import read_hour
 
 utctz=pytz.timezone('UTC')
 if len(sys.argv) == 1:
@@ -21,8 +23,10 @@ for thisfile in sys.argv[1:]:
         a = np.load(thisfile)
         for i in a.files:
             print("\t", i, a[i].shape)
-        ts_min=np.min(a['timestamps'])
-        ts_max=np.max(a['timestamps'])
+        hour=read_hour(thisfile,samples=False)
+        print('\t%d runs of samples at %gHz' % (len(hour.spans), hour.fs))
+        ts_min=hour.spans[0,0]/hour.fs
+        ts_max=(hour.spans[-1,1]-1)/hour.fs
         data_start=dt.datetime.fromtimestamp(ts_min,tz=utctz)
         data_end=dt.datetime.fromtimestamp(ts_max,tz=utctz)
         print('\tFrom:',data_start)
@@ -6,9 +6,14 @@ from scipy.io import savemat
 import numpy as np
 import glob
 import os
+from hourfile import chunk_names, read_hour
 npzFiles = glob.glob("./*.npz")
 for f in npzFiles:
     fm = os.path.splitext(f)[0]+'.mat'
     d = np.load(f)
+    if chunk_names(d.files):
+        # An hour file, possibly with the data in several chunks
+        data = read_hour(f)
+        d = {"timestamps": data.timestamps, "iq": data.iq}
     savemat(fm, d)
     print('generated ', fm, 'from', f)
@@ -2,9 +2,11 @@
 
 # Processing of individual files with streamed data
 #
-# Much of the "temporary" data is in /dev/shm so there needs to be
-# a regular synchronisation to the actual data area. This script is intended
-# to be run from crontab (check the path for the python-script)
+# The receiver spools its records in /dev/shm and moves them to the raw
+# data directory on the disk itself (see Tests/recordspool.py), so /dev/shm
+# only holds the records of the last minutes and the files of the older
+# scripts. This script is intended to be run from crontab (check the path
+# for the python-script)
 #
 #
 # - move files older than one hour to a staging directory
@@ -17,10 +19,14 @@
 #   operating system mostly uses the cache anyway
 
 
-RAWFILES="/dev/shm"
-STAGEDIR="/dev/shm/doppler1h"
+RAWFILES="/home/aurora/Data/raw /dev/shm"
+STAGEDIR="/home/aurora/Data/raw/doppler1h"
 DESTDIR="/home/aurora/Data"
 
 mkdir -p $STAGEDIR
-find $RAWFILES -maxdepth 1 -mmin +65 -name '*.npz' -exec mv {} $STAGEDIR \;
+find $RAWFILES -maxdepth 1 -mmin +65 \( -name '*.dope' -o -name '*.npz' \) \
+    -exec mv {} $STAGEDIR \;
+# combine_rawdatafiles.py imports dopplerrecord.py, hourfile.py and
+# coverage.py, copy them to the same directory (the gap filler,
+# fillDataGapsDirectories.py, also needs gapfill.py)
 python /home/aurora/bin/combine_rawdatafiles.py -i $STAGEDIR -o $DESTDIR -d
@@ -22,6 +22,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import argparse
 import datetime as dt
+from hourfile import read_hour
 
 """
 The suggested processing is to use overlapping 40-s windows to obtain
@@ -66,9 +67,9 @@ def parse_args():
 def main():
     args = parse_args()
     filename = args.input_file
-    mydata = np.load(filename)
-    ts = mydata["timestamps"]
-    iq = mydata["iq"]
+    data = read_hour(filename)
+    ts = data.timestamps
+    iq = data.iq
     ind = np.argsort(ts)
     ts_sorted = ts[ind]  # One gets funny looking spectrograms if the
     iq_sorted = iq[ind]  # samples are not in temporal order...
@@ -26,6 +26,13 @@ import datetime as dt
 import os
 import glob
 import sys
+# The decimation is shared with the receiver scripts: decimation.py is
+# taken from ../Tests, or from the directory of this script when it is
+# deployed without the repository (see README.md)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "Tests"))
+from decimation import DecimationPlan
+from hourfile import read_hour
 
 """
 The suggested processing is to use overlapping 40-s windows to obtain
@@ -98,9 +105,9 @@ day_ts=[]
 day_iq=[]
 for filename in datafiles:
     print(f'Reading {filename}')
-    mydata = np.load(filename)
-    ts = mydata["timestamps"]
-    iq = mydata["iq"]
+    data = read_hour(filename)
+    ts = data.timestamps
+    iq = data.iq
     day_ts=np.concatenate((day_ts,ts))
     day_iq=np.concatenate((day_iq,iq))
 
@@ -129,10 +136,11 @@ print("Decimating...")
 fs=100 # Hz
 q=3 # Decimation factor
 
-ts_decim=ss.decimate(ts_sorted,q)
-iq_decim=ss.decimate(mixedIQ,q)
+plan=DecimationPlan(fs,fs/q)
+ts_decim=ts_sorted[::q]
+iq_decim=plan.decimate(mixedIQ)
 
 print("Plotting...")
-plot_spectrogram(starttime,stoptime,ts_decim, iq_decim, fs/q)
+plot_spectrogram(starttime,stoptime,ts_decim, iq_decim, plan.output_rate)
 
 
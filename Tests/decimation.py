@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+Streaming decimation of the baseband sample stream
+
+The receiver produces a continuous stream of samples at 250kHz, but only
+a few hundred Hz around the carrier are of interest. Instead of collecting
+a full record (60s, 15M samples) and decimating it in one go, the samples
+are fed to the decimator packet by packet as they arrive from the USRP.
+The filter state is kept between the calls, so the output is continuous
+over packet and record boundaries and the CPU load stays flat.
+
+Each stage is a FIR low-pass filter evaluated only at the output instants,
+which is equivalent to a polyphase decimator: the number of multiplications
+is the number of filter taps per *output* sample.
+
+With sc16 samples from the USRP (int16 I and Q, the SC16 dtype) the
+first stage can be a CIC decimator working on integers, so the samples
+are only converted to floating point at the much lower rate after it.
+
+DecimationPlan chooses the stages for a given input and output rate and
+designs their filters (cached, so each design is made only once). The same
+plan is used for decimating whole arrays (DecimationPlan.decimate) in the
+other scripts, so all of them get the same response.
+
+Each channel of a multichannel stream (e.g. the O and X mode antennas)
+can be decimated in its own thread with ChannelDecimator. The filtering
+in scipy releases the GIL, so the channels are decimated on separate cores.
+
+Note that the filters are causal, so the output is delayed by
+StreamingDecimator.delay input samples compared to the input. The first
+2*delay input samples after a reset are needed to fill the filters.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
+import numpy as np
+import scipy.signal as ss
+
+# Complex int16 samples (sc16), as received from the USRP without
+# conversion. Full scale 32767 corresponds to 1.0 in complex64.
+SC16 = np.dtype([("re", np.int16), ("im", np.int16)])
+
+
+class FIRDecimatorStage:
+    """One FIR low-pass + downsampling stage with persistent state
+
+    Without taps a windowed low-pass filter of taps_per_phase*factor+1
+    taps and the cutoff at the output Nyquist frequency is used.
+    """
+
+    def __init__(self, factor, taps_per_phase=20, taps=None):
+        self.factor = int(factor)
+        if taps is None:
+            numtaps = taps_per_phase*self.factor+1
+            taps = ss.firwin(numtaps, 1/self.factor, window="hamming")
+        self.taps = np.asarray(taps, dtype=np.float32)
+        self.delay = (self.taps.size-1)//2
+        self.history = None
+        self.phase = 0   # offset of the next output in the next input block
+
+    def reset(self):
+        """Forget the filter state"""
+        self.history = None
+        self.phase = 0
+
+    def process(self, x):
+        """Filter and downsample a block of samples (time on the last axis)"""
+        nin = x.shape[-1]
+        if nin == 0:
+            return x
+        numtaps = self.taps.size
+        if self.history is None:
+            self.history = np.zeros(x.shape[:-1]+(numtaps-1,), dtype=x.dtype)
+        buf = np.concatenate((self.history, x), axis=-1)
+        # Output n of the convolution is the filter window ending at
+        # buf[n]. upfirdn computes every factor:th output from the start
+        # of its input, so the input is aligned with the next output.
+        first = numtaps-1+self.phase
+        offset = first % self.factor
+        y = ss.upfirdn(self.taps, buf[..., offset:], 1, self.factor, axis=-1)
+        start = (first-offset)//self.factor
+        stop = (buf.shape[-1]-1-offset)//self.factor+1
+        self.phase = (self.phase-nin) % self.factor
+        self.history = buf[..., nin:].copy()
+        return y[..., start:stop]
+
+
+class CICDecimatorStage:
+    """CIC decimator for SC16 samples with persistent state
+
+    order integrators run at the input rate and order combs at the output
+    rate, all in integer arithmetic (cumsum), so there are no
+    multiplications. The integrators wrap around, which does not matter
+    as long as the registers (acc_dtype) hold the growth of the output,
+    16+order*log2(factor) bits. The output is complex64, scaled so that
+    the response is 1.0 at DC.
+
+    The response is sinc^order like, so the stage is only good for the
+    first stage of a cascade, where the pass band is a small part of the
+    output rate.
+    """
+
+    def __init__(self, factor, order, acc_dtype=np.int64):
+        self.factor = int(factor)
+        self.order = int(order)
+        self.acc_dtype = acc_dtype
+        self.delay = self.order*(self.factor-1)//2
+        self.scale = np.float32(1/(32767*float(self.factor)**self.order))
+        self.phase = 0   # offset of the next output in the next input block
+        self.reset()
+
+    def reset(self):
+        """Forget the filter state"""
+        self.integrators = [0]*self.order
+        self.combs = [0]*self.order
+        self.phase = 0
+
+    def process(self, x):
+        """Filter and downsample a block of SC16 samples (time on the last
+        axis), returns complex64"""
+        nin = x.shape[-1]
+        # (..., I/Q, samples) views of the int16 samples
+        iq = np.moveaxis(x.view(np.int16).reshape(x.shape+(2,)), -1, -2)
+        acc = iq.astype(self.acc_dtype, order="C")
+        for k in range(self.order):
+            np.cumsum(acc, axis=-1, out=acc)
+            acc += np.asarray(self.integrators[k])[..., np.newaxis]
+            self.integrators[k] = acc[..., -1].copy()
+        y = acc[..., self.phase::self.factor]
+        self.phase = (self.phase-nin) % self.factor
+        if y.shape[-1] > 0:
+            for k in range(self.order):
+                prev = np.asarray(self.combs[k], dtype=self.acc_dtype)
+                self.combs[k] = y[..., -1].copy()
+                y[..., 1:] -= y[..., :-1].copy()
+                y[..., 0] -= prev
+        out = np.empty(x.shape[:-1]+(y.shape[-1],), dtype=np.complex64)
+        out.real = y[..., 0, :]*self.scale
+        out.imag = y[..., 1, :]*self.scale
+        return out
+
+
+def _cic_order(rate, factor, passband, atten):
+    """Smallest even CIC order attenuating the aliases of the pass band
+    by atten dB, and the accumulator dtype it needs"""
+    # The aliases closest to the pass band come from rate/factor-passband
+    f = (rate/factor-passband)/rate
+    gain = abs(np.sin(np.pi*f*factor)/(factor*np.sin(np.pi*f)))
+    order = int(np.ceil(-atten/(20*np.log10(gain))))
+    order += order % 2     # even, so that the delay is whole samples
+    bits = 16+int(np.ceil(order*np.log2(factor)))
+    return order, np.int32 if bits < 32 else np.int64
+
+
+class StreamingDecimator:
+    """Multistage decimator for a continuous sample stream
+
+    factors is the list of decimation factors of the individual stages,
+    e.g. (50, 50) for 250kHz -> 100Hz, and designs the optional filter
+    taps of each stage (see DecimationPlan). The output dtype is that of
+    the input (complex64 for the USRP samples). cic (factor, order,
+    accumulator dtype) adds a CICDecimatorStage before the others, then
+    the input is SC16 and the output complex64.
+    """
+
+    def __init__(self, factors, taps_per_phase=20, designs=None, cic=None):
+        if designs is None:
+            designs = [None]*len(factors)
+        self.stages = [FIRDecimatorStage(q, taps_per_phase, h)
+                       for q, h in zip(factors, designs)]
+        self.dtype = np.dtype(np.complex64)     # of the input
+        if cic is not None:
+            self.stages.insert(0, CICDecimatorStage(*cic))
+            self.dtype = SC16
+        self.factor = int(np.prod([stage.factor for stage in self.stages]))
+        # The group delay of the cascade in input samples
+        self.delay = 0
+        step = 1
+        for stage in self.stages:
+            self.delay += step*stage.delay
+            step *= stage.factor
+
+    def reset(self):
+        """Forget the filter state, e.g. after a restart of the stream"""
+        for stage in self.stages:
+            stage.reset()
+
+    def align(self, counter):
+        """Put the outputs on the sampling grid of the output rate
+
+        counter is the sample counter of the next input sample. The stages
+        are set so that the outputs, corrected for the delay of the
+        filters, fall on multiples of the total decimation factor of the
+        sample counter. Returns the offset of the first output from the
+        next input sample.
+        """
+        offset = (self.delay-counter) % self.factor
+        digits = offset
+        for stage in self.stages:
+            stage.phase = digits % stage.factor
+            digits //= stage.factor
+        return offset
+
+    def process(self, x):
+        """Decimate a block of samples, returns the new output samples"""
+        for stage in self.stages:
+            x = stage.process(x)
+        return x
+
+
+class ChannelDecimator:
+    """StreamingDecimator for each channel, run in parallel threads
+
+    The input is (channels, samples). All the channels are aligned to the
+    same sample counter, so the outputs of the channels stay time aligned.
+    workers is the number of threads (default one per channel, at most the
+    number of CPUs); with a single worker the channels are decimated in
+    turn in the calling thread.
+    """
+
+    def __init__(self, factors, channels, taps_per_phase=20, workers=None,
+                 designs=None, cic=None):
+        self.decimators = [StreamingDecimator(factors, taps_per_phase,
+                                              designs, cic)
+                           for i in range(channels)]
+        self.factor = self.decimators[0].factor
+        self.delay = self.decimators[0].delay
+        self.dtype = self.decimators[0].dtype
+        if workers is None:
+            workers = min(channels, os.cpu_count() or 1)
+        self.workers = workers
+        self.executor = None
+
+    def __getstate__(self):
+        # The threads are started again where the decimator is used
+        state = self.__dict__.copy()
+        state["executor"] = None
+        return state
+
+    def reset(self):
+        """Forget the filter state, e.g. after a restart of the stream"""
+        for dec in self.decimators:
+            dec.reset()
+
+    def align(self, counter):
+        """Put the outputs on the sampling grid (see StreamingDecimator)"""
+        for dec in self.decimators:
+            offset = dec.align(counter)
+        return offset
+
+    def process(self, x):
+        """Decimate a block of samples, returns the new output samples"""
+        if self.workers > 1:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers,
+                                                   thread_name_prefix="dec")
+            ys = list(self.executor.map(lambda dec, xi: dec.process(xi),
+                                        self.decimators, x))
+        else:
+            ys = [dec.process(xi) for dec, xi in zip(self.decimators, x)]
+        return np.stack(ys)
+
+
+def _stage_numtaps(rate, passband, stopband, atten):
+    """Number of taps (odd) and Kaiser beta for a low-pass filter"""
+    numtaps, beta = ss.kaiserord(atten, (stopband-passband)/(rate/2))
+    # Odd, so that the delay is a whole number of input samples
+    return numtaps | 1, beta
+
+
+@functools.lru_cache(maxsize=None)
+def design_stage(rate, passband, stopband, atten):
+    """Taps of a low-pass filter for a decimation stage (cached)
+
+    The response is flat up to passband and attenuated by atten dB
+    from stopband up, all in Hz at the input rate. The taps are shared
+    between the callers, so they are made read-only.
+    """
+    numtaps, beta = _stage_numtaps(rate, passband, stopband, atten)
+    h = ss.firwin(numtaps, (passband+stopband)/2, window=("kaiser", beta),
+                  fs=rate)
+    h = h.astype(np.float32)
+    h.flags.writeable = False
+    return h
+
+
+def _factorizations(n, max_stages):
+    """Ordered factorizations of n into at most max_stages factors"""
+    if n == 1:
+        yield ()
+        return
+    if max_stages == 0:
+        return
+    for q in range(2, n+1):
+        if n % q == 0:
+            for rest in _factorizations(n//q, max_stages-1):
+                yield (q,)+rest
+
+
+class DecimationPlan:
+    """Stages and filters for decimating from rate to target (Hz)
+
+    The decimation factor is the largest integer that keeps the output
+    rate (output_rate) at or above target. The output is flat up to
+    passband*output_rate/2 and the frequencies that would alias there
+    are attenuated by atten dB. Of all the ways to split the factor into
+    at most max_stages stages the one with the fewest multiplications per
+    output sample (macs_per_output, for each channel) is chosen: the early
+    stages can have short filters, as only the final pass band must stay
+    free of aliases.
+
+    With sc16=True the input is SC16 and the first stage is a CIC
+    decimator (cic = (factor, order, accumulator dtype)) that brings the
+    rate down to at most max_int_rate, so floating point is only used
+    after it. The CIC needs no multiplications.
+    """
+
+    def __init__(self, rate, target, passband=0.9, atten=80, max_stages=3,
+                 sc16=False, max_int_rate=5e3):
+        self.rate = rate
+        self.factor = int(rate/target + 1e-9)
+        if self.factor < 1:
+            raise ValueError("Cannot decimate %gHz to %gHz" % (rate, target))
+        self.output_rate = rate/self.factor
+        self.passband = passband*self.output_rate/2
+        self.atten = atten
+        self.cic = None
+        self.float_rate = rate          # input rate of the FIR stages
+        factor = self.factor
+        if sc16:
+            q = min(q for q in range(1, factor+1) if factor % q == 0 and
+                    (rate/q <= max_int_rate or q == factor))
+            self.cic = (q,)+_cic_order(rate, q, self.passband, atten)
+            self.float_rate = rate/q
+            factor //= q
+        self.factors = min(_factorizations(factor, max_stages),
+                           key=lambda f: (self._cost(f), len(f)))
+        self.macs_per_output = self._cost(self.factors)
+
+    def _stage_specs(self, factors):
+        """Input rate, pass band and stop band of each FIR stage"""
+        specs = []
+        rate = self.float_rate
+        for i, q in enumerate(factors):
+            rate_out = rate/q
+            if i == len(factors)-1:
+                stopband = self.output_rate/2
+            else:
+                # Only what would alias into the final pass band matters
+                stopband = rate_out-self.passband
+            specs.append((rate, self.passband, stopband, self.atten))
+            rate = rate_out
+        return specs
+
+    def _cost(self, factors):
+        """Multiplications per output sample with the given stages"""
+        cost = 0
+        step = 1
+        for q, spec in reversed(list(zip(factors,
+                                         self._stage_specs(factors)))):
+            cost += _stage_numtaps(*spec)[0]*step
+            step *= q
+        return cost
+
+    def designs(self):
+        """Filter taps of the stages"""
+        return [design_stage(*spec)
+                for spec in self._stage_specs(self.factors)]
+
+    def decimator(self):
+        """StreamingDecimator for the plan"""
+        return StreamingDecimator(self.factors, designs=self.designs(),
+                                  cic=self.cic)
+
+    def channel_decimator(self, channels, workers=None):
+        """ChannelDecimator for the plan"""
+        return ChannelDecimator(self.factors, channels, workers=workers,
+                                designs=self.designs(), cic=self.cic)
+
+    def decimate(self, x):
+        """Decimate a whole array (time on the last axis)
+
+        The output is corrected for the delay of the filters, so output
+        sample n is at input sample n*factor, and the signal is taken to
+        be zero outside the array.
+        """
+        dec = self.decimator()
+        offset = dec.align(0)
+        # Output index (at the output rate) of the first output
+        first = (offset-dec.delay)//self.factor
+        pad = np.zeros(x.shape[:-1]+(dec.delay+self.factor,), dtype=dec.dtype)
+        y = np.concatenate((dec.process(x), dec.process(pad)), axis=-1)
+        nout = -(-x.shape[-1]//self.factor)
+        return y[..., -first:-first+nout]
+
+    def __str__(self):
+        stages = [str(q) for q in self.factors]
+        if self.cic is not None:
+            stages.insert(0, "CIC%d(order %d)" % self.cic[0:2])
+        return ("%gHz -> %gHz in stages %s, %d multiplications/output" %
+                (self.rate, self.output_rate, "x".join(stages),
+                 self.macs_per_output))
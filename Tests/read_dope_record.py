@@ -5,11 +5,16 @@ Read one single record and do something with it...
 """
 
 import argparse
+import os
+import sys
 import numpy as np
 import scipy.signal as ss
 from datetime import datetime
 import matplotlib.pyplot as plt
 from numpy.fft import fftshift
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "DataHandling"))
+from dopplerrecord import load_samples
 
 
 def plot_spectrogram(x, fs, titletext=""):
@@ -34,14 +39,10 @@ def main():
     args = parse_args()
     # For a proper datafile, there should be a timestamp, sample frequency
     # and (complex)
-    # data
-    npzfile = np.load(args.input_file)
-    print(npzfile.files)
-    fs = npzfile['fs']
-    filetimestamp = npzfile['timestamp']
-    samples = npzfile['samples']
-
-    mytimestamp = datetime.fromtimestamp(filetimestamp))
+    # data, either in a record (*.dope) or in an npz-file
+    filetimestamp, fs, samples = load_samples(args.input_file)
+
+    mytimestamp = datetime.fromtimestamp(filetimestamp)
     print(mytimestamp)
     plot_spectrogram(samples, fs, mytimestamp.strftime("%Y-%m-%dT%H:%M:%S"))
 
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Spool of the receiver records in /dev/shm, moved to the disk in batches
+
+The records are written to a spool directory in memory (tmpfs), so that
+the receiver never waits for the disk. A background thread moves them to
+the archive directory on the disk in batches: the files of a batch are
+copied, flushed to the disk together (one fsync per file, but only after
+all of them have been written, so the disk can write them in one go),
+renamed into place and the directory flushed once before the spool copies
+are removed. A crash leaves a record in the spool, in the archive, or
+(harmlessly) in both, but never a partial file under the final name.
+
+The spool has a size quota, so a stalled disk or a stopped migration
+cannot fill the memory and take the receiver down. When a record does not
+fit (or writing it to the spool fails), it is written directly to the
+archive directory instead.
+
+Records left in the spool by an earlier run are moved with the first
+batch.
+"""
+
+import collections
+import glob
+import logging
+import os
+import shutil
+import threading
+
+
+def move_batch(src_dir, dst_dir, names):
+    """Move the files to dst_dir (on another file system) as one batch
+
+    Returns the names no longer in src_dir (moved, or removed by someone
+    else in the meantime).
+    """
+    copied = []
+    done = []
+    try:
+        for name in names:
+            try:
+                shutil.copy2(os.path.join(src_dir, name),
+                             os.path.join(dst_dir, name+".tmp"))
+            except FileNotFoundError:
+                done.append(name)
+                continue
+            copied.append(name)
+        for name in copied:
+            fd = os.open(os.path.join(dst_dir, name+".tmp"), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    except OSError:
+        for name in copied:
+            try:
+                os.remove(os.path.join(dst_dir, name+".tmp"))
+            except OSError:
+                pass
+        raise
+    for name in copied:
+        os.replace(os.path.join(dst_dir, name+".tmp"),
+                   os.path.join(dst_dir, name))
+    fd = os.open(dst_dir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    for name in copied:
+        try:
+            os.remove(os.path.join(src_dir, name))
+        except FileNotFoundError:
+            pass
+        done.append(name)
+    return done
+
+
+class RecordSpool:
+    """Size-limited spool of record files, moved to the disk in batches
+
+    save() writes a file with the given function, in the spool if it fits
+    in quota bytes, otherwise directly in archive_dir. The spool is moved
+    to archive_dir every interval s, or as soon as it is half full. The
+    thread is started by the first save(), so the spool can be pickled to
+    a worker process before that.
+    """
+
+    def __init__(self, spool_dir, archive_dir, quota, interval=600,
+                 pattern="doppler*.dope"):
+        self.spool_dir = spool_dir
+        self.archive_dir = archive_dir
+        self.quota = quota
+        self.interval = interval
+        self.pattern = pattern
+        self.files = collections.OrderedDict()  # name: bytes, oldest first
+        self.bytes = 0
+        # Counters since the start
+        self.fallbacks = 0      # records written directly to the disk
+        self.migrated = 0       # records moved to the disk
+        self.failures = 0       # failed batches
+        self.lock = None
+        self.wake = None
+        self.thread = None
+        self.stopping = False
+
+    def start(self):
+        """Start the migration thread"""
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        os.makedirs(self.spool_dir, exist_ok=True)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        for path in sorted(glob.glob(os.path.join(self.spool_dir,
+                                                  self.pattern))):
+            self.add(os.path.basename(path), os.path.getsize(path))
+        if self.files:
+            logging.info("%d records left in the spool %s" %
+                         (len(self.files), self.spool_dir))
+            self.wake.set()
+        self.thread = threading.Thread(target=self.run, name="spool",
+                                       daemon=True)
+        self.thread.start()
+
+    def add(self, name, size):
+        with self.lock:
+            self.bytes += size-self.files.pop(name, 0)
+            self.files[name] = size
+
+    def save(self, name, nbytes, write):
+        """Save a file of about nbytes with write(filename)
+
+        Returns the filename used.
+        """
+        if self.thread is None:
+            self.start()
+        if self.bytes+nbytes <= self.quota:
+            filename = os.path.join(self.spool_dir, name)
+            try:
+                write(filename)
+            except OSError as e:
+                logging.error("Writing to the spool failed: " + str(e))
+            else:
+                self.add(name, os.path.getsize(filename))
+                if self.bytes > self.quota/2:
+                    self.wake.set()
+                return filename
+        else:
+            logging.warning("Record spool full (%d files, %d bytes), "
+                            "writing %s to the disk" %
+                            (len(self.files), self.bytes, name))
+        self.fallbacks += 1
+        self.wake.set()
+        filename = os.path.join(self.archive_dir, name)
+        write(filename)
+        return filename
+
+    def run(self):
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.migrate()
+
+    def migrate(self):
+        """Move the records in the spool to the disk"""
+        with self.lock:
+            names = list(self.files)
+        if not names:
+            return
+        try:
+            done = move_batch(self.spool_dir, self.archive_dir, names)
+        except OSError as e:
+            self.failures += 1
+            logging.error("Moving the records to %s failed: %s" %
+                          (self.archive_dir, e))
+            return
+        with self.lock:
+            for name in done:
+                self.bytes -= self.files.pop(name)
+        self.migrated += len(done)
+        logging.debug("Moved %d records to %s" % (len(done),
+                                                  self.archive_dir))
+
+    def occupancy(self):
+        """The state of the spool as a dictionary"""
+        return {"files": len(self.files), "bytes": self.bytes,
+                "quota": self.quota, "fallbacks": self.fallbacks,
+                "migrated": self.migrated, "failures": self.failures}
+
+    def close(self):
+        """Move the rest of the records to the disk and stop the thread"""
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.wake.set()
+        self.thread.join()
+        self.migrate()
+        logging.info("Spool closed: %d records moved to %s, %d written "
+                     "there directly, %d failed batches" %
+                     (self.migrated, self.archive_dir, self.fallbacks,
+                      self.failures))
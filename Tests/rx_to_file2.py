@@ -3,7 +3,7 @@
 import uhd
 import numpy as np
 import argparse
-import scipy.signal as ss
+from decimation import DecimationPlan
 
 # A simple script based on the examples in the python API.
 #
@@ -38,10 +38,9 @@ def main():
     # For a normal AM station, the bandwidth is about +-18kHz around
     # the carrier wave, so we can reduce the bandwidth quite a bit
     f_target = 2*18e3    # Desired sample frequency
-    q = int(args.rate/f_target)
-    fs_new = args.rate/q
-    print(fs_new)
-    samps2 = ss.decimate(samps, q)
+    plan = DecimationPlan(args.rate, f_target)
+    print(plan)
+    samps2 = plan.decimate(samps)
     with open(args.output_file, 'wb') as f:
         np.save(f, samps2, allow_pickle=False, fix_imports=False)
 
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""
+Building blocks for passing received samples from the UHD receive loop
+to the processing (decimation and file writing)
+
+The receive loop has to keep up with the USRP at all times, so it should
+never wait for the processing, allocate memory or copy samples around.
+The samples are therefore received straight into preallocated slots of a
+ring buffer. A full slot is handed over to the processing through a queue
+and the processing gives it back when it is done with it. Only one side
+owns a slot at any time, so the samples cannot be overwritten while they
+are still being processed.
+
+The processing itself runs in a WorkerPool, a fixed number of threads fed
+through a bounded queue. When the processing cannot keep up, the queue
+fills and the configured policy decides what happens: the receiver waits
+("block"), the oldest waiting job is thrown away ("drop-oldest") or the new
+job is handed to a callback that can, e.g., save the raw samples to disk
+("spill"). Either way the memory use stays bounded.
+
+Optionally the processing runs in a separate process (ProcessStage), which
+reads the samples from a ring in shared memory (SharedSampleRing), so the
+receive loop never has to wait for the GIL.
+"""
+
+import collections
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import signal
+import threading
+import time
+import numpy as np
+
+
+class RingSlot:
+    """One preallocated buffer of the ring and its bookkeeping"""
+
+    def __init__(self, index, data):
+        self.index = index
+        self.data = data
+        self.nsamps = 0         # number of valid samples in data
+        self.start = None       # sample counter of the first sample
+        self.gaps = []          # zero-filled (sample counter, length)
+
+    def clear(self):
+        self.nsamps = 0
+        self.start = None
+        self.gaps = []
+
+
+class SampleRing:
+    """N-slot ring of sample buffers with explicit ownership handoff
+
+    The receiver acquire()s a free slot, fills it and hands it over to the
+    processing (a WorkerPool), which release()s it back to the ring when
+    done. If the receiver finds no free slot, the processing is lagging
+    behind; this is counted in ring_full and the receiver waits for a slot
+    instead of overwriting data in use. Nothing is logged here, as this
+    happens on every slot when the processing keeps lagging; the count is
+    for the periodic summary.
+    """
+
+    def __init__(self, num_slots, channels, slot_samps, dtype=np.complex64):
+        self.slot_samps = slot_samps
+        self.slots = [RingSlot(i, self.allocate((channels, slot_samps), dtype))
+                      for i in range(num_slots)]
+        self.free = queue.Queue()
+        for slot in self.slots:
+            self.free.put(slot)
+        self.ring_full = 0
+
+    def allocate(self, shape, dtype):
+        """Allocate the memory of one slot"""
+        # Write the memory now, so that its pages are not mapped in one by
+        # one by the receive loop (np.zeros would leave that for later)
+        data = np.empty(shape, dtype=dtype)
+        data[...] = 0
+        return data
+
+    def acquire(self):
+        """Get an empty slot for the receiver (blocks if the ring is full)"""
+        try:
+            slot = self.free.get_nowait()
+        except queue.Empty:
+            self.ring_full += 1
+            slot = self.free.get()
+        slot.clear()
+        return slot
+
+    def release(self, slot):
+        """Give a processed slot back to the receiver"""
+        self.free.put(slot)
+
+    def close(self):
+        """Free the memory of the ring"""
+        pass
+
+
+class SharedSampleRing(SampleRing):
+    """SampleRing with the slots in shared memory
+
+    The slots can be attached to in another process (see ProcessStage),
+    so the samples can be processed there without copying them.
+    """
+
+    def __init__(self, num_slots, channels, slot_samps, dtype=np.complex64):
+        self.shms = []
+        SampleRing.__init__(self, num_slots, channels, slot_samps, dtype)
+
+    def allocate(self, shape, dtype):
+        nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.shms.append(shm)
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        data[:] = 0
+        return data
+
+    def specs(self):
+        """What another process needs to attach to the slots"""
+        return [(shm.name, slot.data.shape, slot.data.dtype)
+                for shm, slot in zip(self.shms, self.slots)]
+
+    def close(self):
+        for slot in self.slots:
+            slot.data = None
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.shms = []
+
+
+def attach_shared_slots(specs):
+    """Attach to the slots of a SharedSampleRing in another process"""
+    shms = []
+    slots = []
+    for i, (name, shape, dtype) in enumerate(specs):
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 the memory is always tracked, but the
+            # worker shares the resource tracker of the parent, which
+            # owns the memory anyway
+            shm = shared_memory.SharedMemory(name=name)
+        shms.append(shm)
+        slots.append(RingSlot(i, np.ndarray(shape, dtype=dtype,
+                                            buffer=shm.buf)))
+    return shms, slots
+
+
+def _process_stage_main(conn, specs, func, init):
+    """Main loop of the ProcessStage worker process"""
+    # Ctrl-C is handled by the parent, which then stops the worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if init is not None:
+        init()
+    shms, slots = attach_shared_slots(specs)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        index, nsamps, start, gaps = msg
+        slot = slots[index]
+        slot.nsamps = nsamps
+        slot.start = start
+        slot.gaps = gaps
+        try:
+            conn.send((True, func(slot)))
+        except Exception as e:
+            logging.exception("Job failed in the worker process")
+            conn.send((False, repr(e)))
+    if hasattr(func, "close"):
+        func.close()
+    for slot in slots:
+        slot.data = None
+    for shm in shms:
+        shm.close()
+
+
+class WorkerDied(RuntimeError):
+    """The worker process of a ProcessStage is gone"""
+
+
+class ProcessStage:
+    """Call func for the slots of a SharedSampleRing in a worker process
+
+    The stage is used as the function of a WorkerPool. The pool thread
+    only passes the slot index to the worker process and waits for the
+    result, so the queue policies and statistics work as with threads,
+    but the processing does not compete with the receive loop for the
+    GIL. func (and init, which is called first in the new process) must
+    be picklable. If func has a close() method, it is called in the worker
+    process when the stage is closed.
+
+    If the worker process dies, the slot it had fails and a new process
+    is started (with func as it was given, so any state of the old one is
+    lost). After max_restarts restarts the stage gives up: failed is set
+    and every call raises WorkerDied at once.
+    """
+
+    def __init__(self, ring, func, init=None, max_restarts=3):
+        self.specs = ring.specs()
+        self.func = func
+        self.init = init
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.failed = False
+        self.start()
+
+    def start(self):
+        """Start the worker process"""
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_process_stage_main,
+                                   args=(child_conn, self.specs, self.func,
+                                         self.init),
+                                   name="dsp-process", daemon=True)
+        self.process.start()
+        # Only the worker holds its end now, so recv() fails (instead of
+        # waiting forever) if the worker dies
+        child_conn.close()
+
+    def restart(self):
+        """Start a new worker process after the old one died"""
+        self.conn.close()
+        self.process.join()
+        if self.restarts >= self.max_restarts:
+            self.failed = True
+            raise WorkerDied("Worker process died (exit code %s), given up "
+                             "after %d restarts" % (self.process.exitcode,
+                                                    self.restarts))
+        self.restarts += 1
+        logging.error("Worker process died (exit code %s), restarting it" %
+                      self.process.exitcode)
+        self.start()
+
+    def __call__(self, slot):
+        if self.failed:
+            raise WorkerDied("Worker process died")
+        try:
+            self.conn.send((slot.index, slot.nsamps, slot.start, slot.gaps))
+            ok, result = self.conn.recv()
+        except (EOFError, OSError):
+            self.restart()
+            raise WorkerDied("Worker process died processing a slot")
+        if not ok:
+            raise RuntimeError("Worker process failed: " + result)
+        return result
+
+    def close(self):
+        """Stop the worker process"""
+        if not self.failed and self.process.is_alive():
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.process.join()
+
+
+class WorkerPool:
+    """Fixed number of worker threads fed through a bounded queue
+
+    func is called in a worker thread for every submitted job. When the
+    queue holds maxsize jobs, policy decides what submit() does:
+    "block" waits for room, "drop-oldest" discards the oldest waiting job
+    and "spill" discards the new job. Discarded jobs are passed to
+    on_discard (if given), so that their resources can be released or
+    the data saved elsewhere.
+
+    Note that with more than one worker the jobs may complete out of
+    order, so stateful processing should use a single worker.
+    """
+
+    POLICIES = ("block", "drop-oldest", "spill")
+
+    def __init__(self, func, workers=1, maxsize=4, policy="block",
+                 on_discard=None, name="worker"):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown queue policy " + policy)
+        self.func = func
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_discard = on_discard
+        self.jobs = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        # Counters since the start
+        self.submitted = 0
+        self.done = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed = 0
+        # Statistics since the last report()
+        self.max_depth = 0
+        self.num_jobs = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.total_busy = 0.0
+        self.threads = [threading.Thread(target=self._run,
+                                         name="%s-%d" % (name, i),
+                                         daemon=True)
+                        for i in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, job):
+        """Queue a job for the workers, applying the policy if full"""
+        discarded = None
+        with self.cond:
+            self.submitted += 1
+            if len(self.jobs) >= self.maxsize:
+                if self.policy == "block":
+                    while len(self.jobs) >= self.maxsize:
+                        self.cond.wait()
+                elif self.policy == "drop-oldest":
+                    discarded = self.jobs.popleft()[1]
+                    self.dropped += 1
+                else:
+                    self.spilled += 1
+                    discarded = job
+            if discarded is not job:
+                self.jobs.append((time.monotonic(), job))
+                self.max_depth = max(self.max_depth, len(self.jobs))
+                self.cond.notify_all()
+        if discarded is not None and self.on_discard is not None:
+            self.on_discard(discarded)
+
+    def depth(self):
+        """Number of jobs waiting in the queue"""
+        return len(self.jobs)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.jobs and not self.closed:
+                    self.cond.wait()
+                if not self.jobs:
+                    return
+                queued, job = self.jobs.popleft()
+                self.cond.notify_all()
+            started = time.monotonic()
+            try:
+                self.func(job)
+            except Exception:
+                logging.exception("Job failed in the worker pool")
+                self.failed += 1
+            finished = time.monotonic()
+            with self.cond:
+                self.done += 1
+                self.num_jobs += 1
+                self.total_latency += finished-queued
+                self.max_latency = max(self.max_latency, finished-queued)
+                self.total_busy += finished-started
+
+    def report(self):
+        """Summary of the queue and the job latencies since the last call"""
+        with self.cond:
+            n = max(self.num_jobs, 1)
+            text = ("queue %d/%d (max %d), %d jobs, latency mean %.3fs "
+                    "max %.3fs, busy %.3fs/job, dropped %d, spilled %d, "
+                    "failed %d" % (len(self.jobs), self.maxsize,
+                                   self.max_depth, self.num_jobs,
+                                   self.total_latency/n, self.max_latency,
+                                   self.total_busy/n, self.dropped,
+                                   self.spilled, self.failed))
+            self.max_depth = len(self.jobs)
+            self.num_jobs = 0
+            self.total_latency = 0.0
+            self.max_latency = 0.0
+            self.total_busy = 0.0
+        return text
+
+    def close(self):
+        """Process the queued jobs and stop the workers"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
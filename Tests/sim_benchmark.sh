@@ -0,0 +1,30 @@
+#!/bin/bash
+
+# Benchmark the receive loop against the simulated USRP (sim_uhd.py)
+#
+# Runs streaming_test2.py faster than real time with the decimation both
+# in a thread and in a separate process and prints the throughput and the
+# packet drops of each run. The receiver keeps up with the simulated N200
+# if there are no overflows and no drops other than the one counted for
+# the first packet.
+#
+# Usage: sim_benchmark.sh [speed ...]   (default speeds 2 5 10)
+#        FORMAT=sc16 sim_benchmark.sh ... for the int16 sample path
+
+SPEEDS=${@:-2 5 10}
+FORMAT=${FORMAT:-fc32}
+DURATION=120
+LOGDIR=$(mktemp -d)
+SCRIPTDIR=$(dirname "$0")
+
+for SPEED in $SPEEDS; do
+    for MODE in thread process; do
+        LOG="$LOGDIR/rx_${MODE}_${SPEED}.log"
+        python3 "$SCRIPTDIR/streaming_test2.py" --simulate \
+            -a "speed=$SPEED,duration=$DURATION,seed=1" \
+            --dsp-mode $MODE --cpu-format $FORMAT --log-file "$LOG"
+        echo "speed ${SPEED}x, $FORMAT, DSP in a $MODE:"
+        grep -E "Simulated USRP|Received" "$LOG" | cut -d' ' -f4-
+    done
+done
+rm -r "$LOGDIR"
@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+"""
+Simulated USRP for testing the receiver without hardware
+
+This module mimics the parts of the UHD python API (the uhd module) that
+the streaming scripts use, so that the receive loop can be run and
+benchmarked on any Linux computer, e.g.
+
+    python3 streaming_test2.py --simulate -a "speed=10,duration=600"
+
+The simulated N200 streams 363-sample packets of a CW carrier with a
+slowly varying Doppler shift plus noise. The packets carry time stamps
+from a simulated device clock with a GPSDO-like PPS, so the clock setting
+and the sample counting of the receiver work as with the real device.
+
+The device arguments (-a) configure the simulation:
+
+    speed=1            how many times faster than real time the clock runs
+    duration=0         stop after this many seconds of samples (as if
+                       Ctrl-C was pressed), 0 runs forever
+    drop=0             probability of silently losing a packet
+    overflow=0         probability of an overflow after a packet
+    overflow_len=100   number of packets lost in one overflow
+    overflow_stop=0    1 to stop streaming after an overflow, as devices do
+                       when UHD does not restart them (the N200 is
+                       restarted by UHD)
+    overflow_wedge=0   1 to also ignore the stream commands after such a
+                       stop, until the rx streamer is created again
+    recv_buff_size=1e6 bytes buffered before the receiver falls behind
+                       and overflows
+    doppler=1          amplitude of the Doppler shift (Hz)
+    period=300         period of the Doppler shift variation (s)
+    tx_freq=4.45e6     transmitter frequency (Hz)
+    amplitude=0.1      amplitude of the carrier (full scale 1.0)
+    noise=0.01         standard deviation of the noise
+    seed=None          seed of the random generator
+"""
+
+import enum
+import logging
+import math
+import time
+import numpy as np
+
+MASTER_CLOCK_RATE = 100e6
+SAMPLES_PER_PACKET = 363
+BYTES_PER_SAMPLE = 4    # sc16 over the wire
+
+
+def parse_device_args(args):
+    """Parse "key=value,key=value" device arguments into a dict"""
+    params = {"speed": 1.0, "duration": 0.0, "drop": 0.0, "overflow": 0.0,
+              "overflow_len": 100, "overflow_stop": 0,
+              "overflow_wedge": 0,
+              "recv_buff_size": 1e6, "doppler": 1.0,
+              "period": 300.0, "tx_freq": 4.45e6, "amplitude": 0.1,
+              "noise": 0.01, "seed": None}
+    for item in args.split(","):
+        if "=" not in item:
+            continue
+        key, value = item.split("=", 1)
+        key = key.strip()
+        if key in params:
+            params[key] = int(value) if key in ("overflow_len", "overflow_stop",
+                                                   "overflow_wedge", "seed") \
+                else float(value)
+    return params
+
+
+# ------------------------------------------------------------------
+# uhd.types
+
+
+class TimeSpec:
+    """Time as full seconds and fractional seconds (uhd.types.TimeSpec)"""
+
+    def __init__(self, full_secs=0.0, frac_secs=None):
+        if frac_secs is None:
+            full = math.floor(full_secs)
+            frac_secs = full_secs-full
+            full_secs = full
+        full_secs = int(full_secs)+math.floor(frac_secs)
+        self.full_secs = full_secs
+        self.frac_secs = frac_secs-math.floor(frac_secs)
+
+    @classmethod
+    def from_ticks(cls, ticks, tick_rate):
+        ticks = int(ticks)
+        if tick_rate != int(tick_rate):
+            # e.g. the master clock divided by an odd number
+            full_secs = int(ticks//tick_rate)
+            return cls(full_secs, (ticks-full_secs*tick_rate)/tick_rate)
+        rate = int(tick_rate)
+        return cls(ticks//rate, (ticks % rate)/tick_rate)
+
+    def get_full_secs(self):
+        return self.full_secs
+
+    def get_frac_secs(self):
+        return self.frac_secs
+
+    def get_real_secs(self):
+        return self.full_secs+self.frac_secs
+
+    def to_ticks(self, tick_rate):
+        return self.full_secs*int(tick_rate)+round(self.frac_secs*tick_rate)
+
+    def get_tick_count(self, tick_rate):
+        return round(self.frac_secs*tick_rate)
+
+    def __eq__(self, other):
+        return (self.full_secs == other.full_secs and
+                self.frac_secs == other.frac_secs)
+
+    def __lt__(self, other):
+        return self.get_real_secs() < other.get_real_secs()
+
+    def __add__(self, other):
+        if isinstance(other, TimeSpec):
+            return TimeSpec(self.full_secs+other.full_secs,
+                            self.frac_secs+other.frac_secs)
+        return TimeSpec(self.full_secs, self.frac_secs+other)
+
+    def __repr__(self):
+        return "TimeSpec(%d, %.9f)" % (self.full_secs, self.frac_secs)
+
+
+class RXMetadataErrorCode(enum.Enum):
+    none = 0
+    timeout = 1
+    late = 2
+    broken_chain = 4
+    overflow = 8
+    alignment = 12
+    bad_packet = 15
+
+
+class RXMetadata:
+    """Metadata of one recv() call (uhd.types.RXMetadata)"""
+
+    def __init__(self):
+        self.has_time_spec = False
+        self.time_spec = TimeSpec(0)
+        self.more_fragments = False
+        self.fragment_offset = 0
+        self.start_of_burst = False
+        self.end_of_burst = False
+        self.out_of_sequence = False
+        self.error_code = RXMetadataErrorCode.none
+
+    def strerror(self):
+        if self.error_code == RXMetadataErrorCode.none:
+            return "ERROR_CODE_NONE"
+        return "ERROR_CODE_" + self.error_code.name.upper()
+
+
+class StreamMode(enum.Enum):
+    start_cont = 97
+    stop_cont = 111
+    num_done = 100
+    num_more = 109
+
+
+class StreamCMD:
+    """Stream command (uhd.types.StreamCMD)"""
+
+    def __init__(self, stream_mode):
+        self.stream_mode = stream_mode
+        self.num_samps = 0
+        self.stream_now = True
+        self.time_spec = TimeSpec(0)
+
+
+class TuneRequest:
+    """Tune request (uhd.types.TuneRequest)"""
+
+    def __init__(self, target_freq, lo_off=0.0):
+        self.target_freq = target_freq
+        self.lo_off = lo_off
+
+
+class SensorValue:
+    """Sensor reading (uhd.types.SensorValue), value is a string"""
+
+    def __init__(self, name, value, unit=""):
+        self.name = name
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        self.value = str(value)
+        self.unit = unit
+
+    def to_bool(self):
+        return self.value == "true"
+
+    def to_int(self):
+        return int(self.value)
+
+    def to_real(self):
+        return float(self.value)
+
+    def __str__(self):
+        return "%s: %s %s" % (self.name, self.value, self.unit)
+
+
+class types:
+    """Namespace as uhd.types"""
+    TimeSpec = TimeSpec
+    RXMetadata = RXMetadata
+    RXMetadataErrorCode = RXMetadataErrorCode
+    StreamMode = StreamMode
+    StreamCMD = StreamCMD
+    TuneRequest = TuneRequest
+    SensorValue = SensorValue
+
+
+class libpyuhd:
+    """Namespace as uhd.libpyuhd"""
+
+    class types:
+        time_spec = TimeSpec
+
+
+# ------------------------------------------------------------------
+# uhd.usrp
+
+
+class SimClock:
+    """Device clock with a GPSDO
+
+    The GPS time follows the computer clock, but runs speed times faster.
+    The device time is the GPS time plus an offset that is set with
+    set_time_next_pps() (valid from the next PPS, as on the device) or
+    set_time_now(). Times are in seconds (float).
+    """
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.epoch = time.time()
+        self.mono0 = time.monotonic()
+        self.offset = -self.epoch   # the device time starts from zero
+        self.pending = None         # (GPS time of the PPS, new offset)
+
+    def gps_now(self):
+        return self.epoch+(time.monotonic()-self.mono0)*self.speed
+
+    def set_next_pps(self, device_time):
+        """Set the device time at the next PPS"""
+        pps = math.floor(self.gps_now())+1
+        self.pending = (pps, device_time-pps)
+
+    def apply_pending(self, gps_time):
+        if self.pending is not None and gps_time >= self.pending[0]:
+            self.offset = self.pending[1]
+            self.pending = None
+
+    def now(self):
+        gps_time = self.gps_now()
+        self.apply_pending(gps_time)
+        return gps_time+self.offset
+
+    def last_pps(self):
+        gps_time = self.gps_now()
+        self.apply_pending(gps_time)
+        return math.floor(gps_time)+self.offset
+
+    def wait_until(self, device_time, timeout):
+        """Sleep until the device time, returns False after timeout"""
+        delay = (device_time-self.now())/self.speed
+        if delay <= 0:
+            return True
+        time.sleep(min(delay, timeout))
+        return delay <= timeout
+
+
+class StreamArgs:
+    """Stream arguments (uhd.usrp.StreamArgs)"""
+
+    def __init__(self, cpu_format, otw_format):
+        self.cpu_format = cpu_format
+        self.otw_format = otw_format
+        self.args = ""
+        self.channels = [0]
+
+
+class RXStreamer:
+    """Simulated rx streamer returning packets paced by the device clock"""
+
+    def __init__(self, usrp, st_args):
+        self.usrp = usrp
+        self.params = usrp.params
+        self.channels = list(st_args.channels)
+        self.cpu_format = st_args.cpu_format
+        self.rng = np.random.default_rng(self.params["seed"])
+        self.streaming = False
+        self.wedged = False         # ignores the stream commands
+        self.next_sample = 0        # sample counter of the next packet
+        self.stop_sample = None     # end of the simulation (duration)
+        self.packet = None          # samples of the current packet
+        self.packet_start = 0
+        self.packet_offset = 0      # samples of the packet already read
+        self.lost = []              # (first sample, number of samples)
+        self.num_packets = 0
+        self.num_samps = 0
+        self.num_overflows = 0
+        self.wall_start = None
+        # The number of packets that fit into the receive buffer
+        self.buffer_packets = max(1, int(self.params["recv_buff_size"] /
+                                         (BYTES_PER_SAMPLE *
+                                          SAMPLES_PER_PACKET)))
+
+    def get_max_num_samps(self):
+        return SAMPLES_PER_PACKET
+
+    def get_num_channels(self):
+        return len(self.channels)
+
+    def issue_stream_cmd(self, stream_cmd):
+        rate = self.usrp.rate
+        if self.wedged:
+            return
+        if stream_cmd.stream_mode == StreamMode.start_cont:
+            if stream_cmd.stream_now:
+                start = self.usrp.clock.now()+0.01
+            else:
+                start = stream_cmd.time_spec.get_real_secs()
+            next_sample = int(math.ceil(round(start*rate, 3)))
+            if self.wall_start is not None:
+                # Restarted, the samples since the stop are lost
+                self.lost.append((self.next_sample,
+                                  next_sample-self.next_sample))
+            self.next_sample = next_sample
+            self.packet = None
+            self.streaming = True
+            if self.wall_start is None:
+                self.wall_start = time.monotonic()
+                if self.params["duration"]:
+                    self.stop_sample = self.next_sample + \
+                        int(self.params["duration"]*rate)
+        elif stream_cmd.stream_mode == StreamMode.stop_cont:
+            self.streaming = False
+            if self.packet is not None:
+                self.next_sample = self.packet_start+self.packet_offset
+            self.packet = None
+
+    def signal(self, first, num):
+        """Samples of the simulated signal from the sample counter first"""
+        p = self.params
+        rate = self.usrp.rate
+        n = first+np.arange(num)
+        # The carrier is at f0 in the baseband. The sample counter is
+        # split into seconds and samples to keep the phase accurate.
+        f0 = p["tx_freq"]-self.usrp.freq
+        cycles = (f0*(n//int(rate))) % 1.0 + f0*(n % int(rate))/rate
+        # Doppler shift A*sin(2*pi*t/P) integrated to phase
+        doppler = -p["doppler"]*p["period"] * \
+            np.cos(2*np.pi*(n/rate)/p["period"])
+        phase = 2*np.pi*cycles+doppler
+        x = np.empty((len(self.channels), num), dtype=np.complex64)
+        for i in range(len(self.channels)):
+            # The channels (dipoles) see the carrier in different phases
+            noise = self.rng.standard_normal((2, num))*p["noise"]
+            x[i] = p["amplitude"]*np.exp(1j*(phase+i*np.pi/2)) + \
+                noise[0]+1j*noise[1]
+        return x
+
+    def next_packet(self, metadata, timeout):
+        """Wait for the next packet, returns False if there is none"""
+        rate = self.usrp.rate
+        clock = self.usrp.clock
+        p = self.params
+        while True:
+            end = (self.next_sample+SAMPLES_PER_PACKET)/rate
+            if not clock.wait_until(end, timeout):
+                metadata.error_code = RXMetadataErrorCode.timeout
+                return False
+            # When the receiver falls behind by more than the receive
+            # buffer, the device overflows and the receiver continues
+            # from the newest packet
+            behind = (int(clock.now()*rate)-self.next_sample) // \
+                SAMPLES_PER_PACKET - 1
+            if behind > self.buffer_packets:
+                skip = behind
+            elif p["overflow"] and self.rng.random() < p["overflow"]:
+                skip = int(p["overflow_len"])
+            else:
+                skip = 0
+            if skip:
+                self.lost.append((self.next_sample, skip*SAMPLES_PER_PACKET))
+                self.next_sample += skip*SAMPLES_PER_PACKET
+                self.num_overflows += 1
+                metadata.error_code = RXMetadataErrorCode.overflow
+                metadata.has_time_spec = True
+                metadata.time_spec = TimeSpec.from_ticks(self.next_sample,
+                                                         rate)
+                if p["overflow_stop"]:
+                    self.streaming = False
+                    self.wedged = bool(p["overflow_wedge"])
+                return False
+            # A packet lost on the network only shows in the time stamps
+            if p["drop"] and self.rng.random() < p["drop"]:
+                self.lost.append((self.next_sample, SAMPLES_PER_PACKET))
+                self.next_sample += SAMPLES_PER_PACKET
+                continue
+            break
+        self.packet = self.signal(self.next_sample, SAMPLES_PER_PACKET)
+        self.packet_start = self.next_sample
+        self.packet_offset = 0
+        self.next_sample += SAMPLES_PER_PACKET
+        self.num_packets += 1
+        return True
+
+    def recv(self, buffer, metadata, timeout=0.1):
+        """Receive at most one packet into buffer (channels, samples)
+
+        With the sc16 cpu_format the buffer has 4-byte elements, e.g. a
+        structured dtype of two int16. The buffer must be C-contiguous:
+        UHD would receive into a contiguous copy of any other buffer, and
+        the samples would never reach it, so that is an error here.
+        """
+        if not buffer.flags.c_contiguous:
+            raise ValueError("recv() buffer is not C-contiguous, UHD would "
+                             "receive into a copy of it")
+        metadata.error_code = RXMetadataErrorCode.none
+        metadata.more_fragments = False
+        if not self.streaming:
+            time.sleep(timeout/self.usrp.clock.speed)
+            metadata.error_code = RXMetadataErrorCode.timeout
+            return 0
+        if self.packet is None:
+            if self.stop_sample is not None and \
+                    self.next_sample >= self.stop_sample:
+                self.log_summary()
+                raise KeyboardInterrupt
+            if not self.next_packet(metadata, timeout):
+                return 0
+        if buffer.ndim == 1:
+            buffer = buffer.reshape(1, -1)
+        num = min(buffer.shape[-1], SAMPLES_PER_PACKET-self.packet_offset)
+        x = self.packet[:, self.packet_offset:self.packet_offset+num]
+        if self.cpu_format == "sc16":
+            # int16 I/Q pairs, full scale 32767 as in UHD
+            buffer = buffer.view(np.int16)
+            buffer[:, 0:2*num:2] = np.clip(np.rint(x.real*32767), -32768,
+                                           32767)
+            buffer[:, 1:2*num:2] = np.clip(np.rint(x.imag*32767), -32768,
+                                           32767)
+        else:
+            buffer[:, 0:num] = x
+        metadata.has_time_spec = True
+        metadata.time_spec = TimeSpec.from_ticks(
+            self.packet_start+self.packet_offset, self.usrp.rate)
+        metadata.fragment_offset = self.packet_offset
+        self.packet_offset += num
+        if self.packet_offset < SAMPLES_PER_PACKET:
+            metadata.more_fragments = True
+        else:
+            self.packet = None
+        self.num_samps += num
+        return num
+
+    def log_summary(self):
+        """Log the throughput of the simulated stream"""
+        if self.wall_start is None:
+            return
+        wall = time.monotonic()-self.wall_start
+        lost = sum(n for _, n in self.lost)
+        logging.info("Simulated USRP: %d samples in %d packets in %.1fs "
+                     "(%.0f samples/s), %d overflows, %d samples lost" %
+                     (self.num_samps, self.num_packets, wall,
+                      self.num_samps/max(wall, 1e-9), self.num_overflows,
+                      lost))
+
+
+class MultiUSRP:
+    """Simulated N200 with a GPSDO (uhd.usrp.MultiUSRP)"""
+
+    def __init__(self, args=""):
+        self.params = parse_device_args(args)
+        self.clock = SimClock(self.params["speed"])
+        self.rate = 250e3
+        self.freq = 0.0
+        self.gain = 0.0
+        self.clock_source = "internal"
+        self.time_source = "none"
+        self.streamer = None
+        logging.info("Simulated USRP with " + str(self.params))
+
+    def set_clock_source(self, source, mboard=0):
+        self.clock_source = source
+
+    def set_time_source(self, source, mboard=0):
+        self.time_source = source
+
+    def get_mboard_sensor(self, name, mboard=0):
+        if name in ("gps_locked", "ref_locked"):
+            return SensorValue(name, True)
+        if name == "gps_time":
+            return SensorValue(name, int(self.clock.gps_now()), "seconds")
+        if name in ("gps_gpgga", "gps_gprmc"):
+            return SensorValue(name, "$GP" + name[-3:].upper() + ",SIM")
+        raise KeyError("No sensor " + name)
+
+    def get_time_now(self, mboard=0):
+        return TimeSpec(self.clock.now())
+
+    def get_time_last_pps(self, mboard=0):
+        return TimeSpec(self.clock.last_pps())
+
+    def set_time_now(self, time_spec, mboard=0):
+        self.clock.pending = None
+        self.clock.offset = time_spec.get_real_secs()-self.clock.gps_now()
+
+    def set_time_next_pps(self, time_spec, mboard=0):
+        self.clock.set_next_pps(time_spec.get_real_secs())
+
+    def set_rx_rate(self, rate, chan=0):
+        # The N200 can only decimate the master clock by an integer
+        self.rate = MASTER_CLOCK_RATE/max(1, round(MASTER_CLOCK_RATE/rate))
+
+    def get_rx_rate(self, chan=0):
+        return self.rate
+
+    def set_rx_freq(self, tune_request, chan=0):
+        self.freq = tune_request.target_freq
+
+    def get_rx_freq(self, chan=0):
+        return self.freq
+
+    def set_rx_gain(self, gain, chan=0):
+        self.gain = gain
+
+    def get_rx_gain(self, chan=0):
+        return self.gain
+
+    def get_rx_num_channels(self):
+        return 2
+
+    def get_rx_stream(self, st_args):
+        streamer = RXStreamer(self, st_args)
+        old = self.streamer
+        if old is not None:
+            # A new streamer continues the simulation of the old one
+            old.streaming = False
+            for name in ("rng", "next_sample", "stop_sample", "lost",
+                         "num_packets", "num_samps", "num_overflows",
+                         "wall_start"):
+                setattr(streamer, name, getattr(old, name))
+        self.streamer = streamer
+        return streamer
+
+
+class usrp:
+    """Namespace as uhd.usrp"""
+    MultiUSRP = MultiUSRP
+    StreamArgs = StreamArgs
@@ -9,16 +9,45 @@ TODO
   of missed packets. However, as we normally use a sample rate of 250kHz with a decimation down
   to 100Hz, a few lost packets should not be an issue in practice.
 - error handling somewhat missing as of now :-)
+
+The samples are received into a ring of preallocated buffers and decimated
+in a worker thread as they arrive (see rxpipeline.py and decimation.py),
+so only the decimated records are kept in memory. With --dsp-mode process
+the decimation and file writing run in a separate process that reads the
+samples from shared memory, so they do not compete with the receive loop
+for the GIL.
+
+The records are written to a spool in memory (/dev/shm) and moved to the
+disk in batches (see recordspool.py).
+
+The start-up is kept short: the filters are designed (and scipy imported)
+and the USRP tuned while waiting for the PPS edges that set the time, and
+the durations of the start-up phases are logged.
 """
 
+import time
+_launched = time.monotonic()    # for the start-up time, before the imports
 import argparse
+import concurrent.futures
 import numpy as np
-import uhd
-import scipy.signal as ss
+try:
+    import uhd
+except ImportError:
+    uhd = None      # only the simulated USRP (--simulate) can be used
+from rxpipeline import (SampleRing, SharedSampleRing, ProcessStage,
+                        WorkerPool)
+from telemetry import Telemetry, PhaseTimer, log_buckets
+from recordspool import RecordSpool
 from datetime import datetime
-import time
+import functools
 import logging
+import os
+import sys
 import threading
+# The record format is shared with the data handling scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "DataHandling"))
+from dopplerrecord import write_record, HEADER_SIZE
 
 
 def parse_args():
@@ -30,51 +59,561 @@ def parse_args():
     parser.add_argument("-r", "--rate", default=250e3, type=float,
                         help="Sample rate in Hz (default 250kHz)")
     parser.add_argument("-g", "--gain", type=int, default=10)
-    parser.add_argument("-c", "--channel", type=int, default=0)
+    parser.add_argument("-c", "--channels", type=int, nargs="+", default=[0],
+                        help="USRP channels to receive, e.g. 0 1 for the "
+                        "O and X mode antennas (default 0)")
     parser.add_argument("-d", "--duration", type=int, default=60,
                         help="Duration for individual record files (s)")
     parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("--simulate", action="store_true",
+                        help="Use a simulated USRP (sim_uhd.py), the device "
+                        "arguments (-a) configure the simulation")
+    parser.add_argument("--log-file",
+                        default="/home/aurora/UNIS-DopplerRX/Tests/errorlog.txt")
     parser.add_argument("--fs500", action="store_true",
                         help="Decimate to 500Hz sampling instead of 100Hz")
+    parser.add_argument("--ring-slots", type=int, default=8,
+                        help="Number of one-second receive buffers (default 8)")
+    parser.add_argument("--dsp-policy", default="block",
+                        choices=WorkerPool.POLICIES,
+                        help="What to do when the decimation falls behind")
+    parser.add_argument("--spill-dir", default="/home/aurora/Data/spill",
+                        help="Directory for raw samples with --dsp-policy spill")
+    parser.add_argument("--cpu-format", default="fc32",
+                        choices=("fc32", "sc16"),
+                        help="Receive complex64 samples (fc32) or int16 I/Q "
+                        "(sc16, half the memory, the first decimation "
+                        "stage works on integers)")
+    parser.add_argument("--stall-timeout", type=float, default=0.5,
+                        help="Restart the stream if no samples arrive "
+                        "in this time (s, default 0.5s)")
+    parser.add_argument("--hang-timeout", type=float, default=10,
+                        help="Stop the stream if recv() has not returned in "
+                        "this time, and exit if that does not help (s, "
+                        "default 10s, 0 disables the watchdog)")
+    parser.add_argument("--max-gap-fill", type=float, default=1.0,
+                        help="Fill gaps up to this long (s) with zeros, "
+                        "longer gaps split the records (default 1s)")
+    parser.add_argument("--dsp-threads", type=int, default=None,
+                        help="Threads for decimating the channels in "
+                        "parallel (default one per channel and CPU)")
+    parser.add_argument("--metrics-interval", type=float, default=60,
+                        help="Interval of the metrics files and the summary "
+                        "log lines (default 60s)")
+    parser.add_argument("--metrics-json", default=None,
+                        help="Write the receiver metrics to this JSON file")
+    parser.add_argument("--metrics-prom", default=None,
+                        help="Write the receiver metrics to this Prometheus "
+                        "textfile (e.g. for the node exporter)")
+    parser.add_argument("--spool-dir", default="/dev/shm",
+                        help="Directory in memory for the new records")
+    parser.add_argument("--archive-dir", default="/home/aurora/Data/raw",
+                        help="Directory on the disk where the records are "
+                        "moved from the spool")
+    parser.add_argument("--spool-quota", type=float, default=64,
+                        help="Size limit of the spool (MB, default 64MB), "
+                        "records that do not fit go directly to the disk")
+    parser.add_argument("--spool-interval", type=float, default=600,
+                        help="Interval of moving the records to the disk "
+                        "(s, default 600s)")
+    parser.add_argument("--dsp-mode", default="thread",
+                        choices=("thread", "process"),
+                        help="Decimate in a thread or in a separate process "
+                        "reading the samples from shared memory")
     return parser.parse_args()
 
 
-def decimate_100Hz_to_file(mytime, samples, fs):
-    """Reduce the sample rate before saving to file"""
-    x1 = ss.decimate(samples, 50)
-    x2 = ss.decimate(x1, 50)
-    fs_new = (fs//50)//50
-    mydt = datetime.utcfromtimestamp(mytime)
-    filename = "/dev/shm/doppler"+mydt.strftime("%Y-%m-%dT%H:%M:%S")
-    logging.debug("Fs=" + str(fs_new) + "Hz " + filename)
-    np.savez(filename, timestamp=mytime, fs=fs_new, samples=x2.flatten())
-
+def save_record(start_count, samples, gaps, description, spool):
+    """Save one record of decimated samples to file (see dopplerrecord.py)
 
-def decimate_500Hz_to_file(mytime, samples, fs):
-    """Reduce the sample rate before saving to file"""
-    x1 = ss.decimate(samples, 50)
-    x2 = ss.decimate(x1, 10)
-    fs_new = (fs//50)//10
+    start_count is the sample counter of the first sample and gaps the
+    (sample counter, number of samples) of the samples lost at the
+    receiver and replaced with zeros. description has the rest of the
+    header fields (rx_rate, factor, channels, freq and gain). The file is
+    written to the spool (see recordspool.py).
+    """
+    mytime = start_count/description["rx_rate"]
     mydt = datetime.utcfromtimestamp(mytime)
-    filename = "/dev/shm/doppler"+mydt.strftime("%Y-%m-%dT%H:%M:%S")
-    logging.debug("Fs=" + str(fs_new) + "Hz " + filename)
-    np.savez(filename, timestamp=mytime, fs=fs_new, samples=x2)
+    name = "doppler"+mydt.strftime("%Y-%m-%dT%H:%M:%S")+".dope"
+    nbytes = HEADER_SIZE+16*len(gaps)+samples.size*8
+    filename = spool.save(name, nbytes, lambda filename: write_record(
+        filename, samples, start_count, gaps=gaps, **description))
+    logging.debug("Fs=%gHz %s" % (description["rx_rate"] /
+                                  description["factor"], filename))
 
-def main():
-    args = parse_args()
 
-    logging.basicConfig(level=logging.DEBUG,format='%(asctime)s %(levelname)s %(message)s',filename='/home/aurora/UNIS-DopplerRX/Tests/errorlog.txt')
+def setup_logging(filename):
+    """Log to the error log of the receiver"""
+    logging.basicConfig(level=logging.DEBUG,format='%(asctime)s %(levelname)s %(message)s',filename=filename)
     #if args.verbose:
     #    logging.basicConfig(level=logging.DEBUG,format='%(asctime)s %(message)s',filename='/home/aurora/UNIS-DopplerRX/Tests/errorlog.txt')
     #else:
     #    logging.basicConfig(level=logging.INFO,format='%(asctime)s %(message)s',filename='/home/aurora/UNIS-DopplerRX/Tests/errorlog.txt')
 
+
+def fill_gap(slot, counter, gap, samps, ring, dsp):
+    """Replace the samples missing before the packet just received with zeros
+
+    The packet (samps samples with the sample counter counter) has been
+    received at the end of the slot. It is moved after gap zeros, and any
+    slots filled up on the way are handed to the processing. Returns the
+    slot where the packet is now.
+    """
+    packet = slot.data[:, slot.nsamps:slot.nsamps+samps].copy()
+    slot_samps = ring.slot_samps
+    start = counter-gap
+    if slot.start is None:
+        slot.start = start
+    while gap > 0:
+        # Each slot has the part of the gap that is in it
+        n = min(gap, slot_samps-slot.nsamps)
+        slot.data[:, slot.nsamps:slot.nsamps+n] = 0
+        slot.nsamps += n
+        if n > 0:
+            slot.gaps.append((start, n))
+        start += n
+        gap -= n
+        if slot.nsamps + samps > slot_samps:
+            dsp.submit(slot)
+            slot = ring.acquire()
+            slot.start = start
+    slot.data[:, slot.nsamps:slot.nsamps+samps] = packet
+    return slot
+
+
+def sync_time(usrp):
+    """Set the USRP time to the GPS time at the next PPS edge
+
+    Returns the first full second of the new time at which a stream can
+    be started, which may be before the new time is valid.
+    """
+    # Sleep until just after the next PPS edge, when the GPSDO has
+    # updated its time, instead of polling for the edge
+    now = usrp.get_time_now().get_real_secs()
+    last_pps = usrp.get_time_last_pps().get_real_secs()
+    time.sleep(1.0-(now-last_pps) % 1.0+0.2)
+    gps_time = usrp.get_mboard_sensor("gps_time").to_int()
+    old_time = usrp.get_time_now().get_real_secs()
+    usrp.set_time_next_pps(uhd.libpyuhd.types.time_spec(gps_time+1))
+    # The new time is valid after the next PPS. A start at the PPS after
+    # that can already be commanded, unless the old time is past it.
+    if old_time >= gps_time+1:
+        time.sleep(1.0)
+    return gps_time+2
+
+
+def next_start_time(usrp):
+    """First full second of the USRP time far enough ahead for a start"""
+    now = usrp.get_time_now()
+    return now.get_full_secs()+(1 if now.get_frac_secs() < 0.5 else 2)
+
+
+def set_rate(usrp, args):
+    """Set the sample rate of the channels
+
+    Returns the rate that the USRP actually uses, which is the requested
+    rate rounded to one that the USRP supports (e.g. the master clock
+    divided by an integer).
+    """
+    for channel in args.channels:
+        usrp.set_rx_rate(args.rate, channel)
+    rate = usrp.get_rx_rate(args.channels[0])
+    if rate != args.rate:
+        logging.warning("Sample rate %gHz requested, the USRP uses %.6fHz" %
+                        (args.rate, rate))
+    return rate
+
+
+def tune(usrp, args):
+    """Set the frequency and gain of the channels"""
+    for channel in args.channels:
+        usrp.set_rx_freq(uhd.types.TuneRequest(args.freq), channel)
+        usrp.set_rx_gain(args.gain, channel)
+
+
+def prepare_decimation(args, rate, nchan):
+    """Design the filters of the decimation and run them once
+
+    Returns the DecimationPlan and a ChannelDecimator for nchan channels
+    receiving at rate.
+    The filters are run on a second of zeros, so that the code is loaded
+    and the buffers allocated before the first samples arrive.
+    """
+    # scipy is imported here, as the import takes over a second
+    from decimation import DecimationPlan
+    # With sc16 the samples stay int16 until the first (CIC) stage
+    sc16 = args.cpu_format == "sc16"
+    if args.fs500:
+        plan = DecimationPlan(rate, 500, sc16=sc16)
+    else:
+        plan = DecimationPlan(rate, 100, sc16=sc16)
+    decimator = plan.channel_decimator(nchan, workers=args.dsp_threads)
+    decimator.process(np.zeros((nchan, int(rate)),
+                               dtype=decimator.dtype))
+    decimator.reset()
+    return plan, decimator
+
+
+def start_stream(streamer, full_secs):
+    """Start the continuous stream at a full second of the USRP time"""
+    stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
+    stream_cmd.stream_now = False
+    stream_cmd.time_spec = uhd.libpyuhd.types.time_spec(full_secs)
+    streamer.issue_stream_cmd(stream_cmd)
+
+
+def restart_stream(usrp, streamer, metadata, buffer):
+    """Stop the stream and start it again on one of the next PPS edges
+
+    The lost samples show as a gap in the sample counter of the new
+    stream, so the timing of the records is not affected.
+    """
+    stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.stop_cont)
+    streamer.issue_stream_cmd(stream_cmd)
+    # Throw away what is left in the receive buffers
+    while streamer.recv(buffer, metadata, 0.1):
+        pass
+    start_stream(streamer, next_start_time(usrp))
+
+
+def sample_counter(time_spec, rate):
+    """Sample clock count of a time stamp"""
+    # Rounding, as frac_secs*rate is not always exactly an integer (nor
+    # the rate, when the USRP cannot use the requested rate exactly)
+    return int(round(int(time_spec.get_full_secs())*rate +
+                     time_spec.get_frac_secs()*rate))
+
+
+class StreamSupervisor:
+    """Keep the samples of the USRP coming without restarting the receiver
+
+    recv() receives like streamer.recv() and watches the stream. When no
+    samples have arrived for stall_timeout s (only timeouts or errors),
+    the stream is stopped and started again on a PPS edge. If that does
+    not bring the samples back, the rx streamer is destroyed and created
+    again, until the samples are back. The USRP time, the tuning and the
+    filters are kept, so an outage only shows as a gap in the sample
+    counter. The duration of each outage is logged when it ends.
+
+    A watchdog thread checks that recv() itself returns. If a call has
+    hung for hang_timeout s, the watchdog stops the stream, which should
+    make recv() return. If it is still hung after another hang_timeout s,
+    the process exits, to be restarted by the service manager.
+    """
+
+    def __init__(self, usrp, st_args, stall_timeout, telemetry,
+                 hang_timeout=0):
+        self.usrp = usrp
+        self.st_args = st_args
+        self.stall_timeout = stall_timeout
+        self.hang_timeout = hang_timeout
+        self.streamer = usrp.get_rx_stream(st_args)
+        self.metadata = uhd.types.RXMetadata()
+        self.deadline = None        # samples are expected by this time
+        self.last_samples = None    # when the last samples arrived
+        self.attempts = 0           # recoveries since the last samples
+        self.recv_started = None    # when the running recv() was called
+        self.restarts = telemetry.counter("restarts",
+                                          "Restarts of a stalled stream")
+        self.recreations = telemetry.counter("streamer_recreations",
+                                             "Times the rx streamer was "
+                                             "created again")
+        self.outages = telemetry.histogram("outage_seconds",
+                                           "Time without samples per "
+                                           "stalled stream",
+                                           log_buckets(0.1, 1000.0))
+        self.stop_event = threading.Event()
+        self.watchdog = None
+
+    def start(self, full_secs):
+        """Start the stream at a full second of the USRP time"""
+        start_stream(self.streamer, full_secs)
+        # The first samples arrive within 3s
+        self.last_samples = time.monotonic()
+        self.deadline = self.last_samples+3+self.stall_timeout
+        if self.hang_timeout and self.watchdog is None:
+            self.watchdog = threading.Thread(target=self.watch,
+                                             name="watchdog", daemon=True)
+            self.watchdog.start()
+
+    def recv(self, buffer):
+        """Receive samples into buffer, returns the number of samples"""
+        self.recv_started = time.monotonic()
+        samps = self.streamer.recv(buffer, self.metadata)
+        now = time.monotonic()
+        self.recv_started = None
+        if samps:
+            if self.attempts:
+                outage = now-self.last_samples
+                self.outages.observe(outage)
+                logging.warning("Samples back after %.1fs without, %d "
+                                "restarts (%d in total)" %
+                                (outage, self.attempts, self.restarts.value))
+                self.attempts = 0
+            self.last_samples = now
+            self.deadline = now+self.stall_timeout
+        elif now >= self.deadline:
+            self.recover(buffer)
+        return samps
+
+    def recover(self, buffer):
+        """Restart a stalled stream, or create the streamer again"""
+        self.attempts += 1
+        self.restarts.inc()
+        try:
+            if self.attempts == 1:
+                logging.warning("No samples for %.1fs, restarting the "
+                                "stream" %
+                                (time.monotonic()-self.last_samples))
+                restart_stream(self.usrp, self.streamer, self.metadata,
+                               buffer)
+            else:
+                logging.warning("No samples after %d restarts, creating "
+                                "the rx streamer again" % (self.attempts-1))
+                self.recreate()
+        except RuntimeError as e:
+            logging.error("Restarting the stream failed: " + str(e))
+        # Wait for the start on a PPS edge, and longer after each failure
+        self.deadline = time.monotonic()+self.stall_timeout + \
+            3*min(self.attempts, 20)
+
+    def recreate(self):
+        """Destroy the rx streamer and start a new one"""
+        self.recreations.inc()
+        try:
+            self.stop()
+        except RuntimeError:
+            pass
+        # The channels can only have one streamer, so the old one is
+        # destroyed first
+        self.streamer = None
+        self.streamer = self.usrp.get_rx_stream(self.st_args)
+        start_stream(self.streamer, next_start_time(self.usrp))
+
+    def watch(self):
+        """Watchdog thread for a recv() that does not return"""
+        stopped = None
+        while not self.stop_event.wait(self.hang_timeout/4):
+            started = self.recv_started
+            if started is None or \
+                    time.monotonic()-started < self.hang_timeout:
+                continue
+            if stopped != started:
+                logging.error("recv() has not returned in %.1fs, stopping "
+                              "the stream" % (time.monotonic()-started))
+                stopped = started
+                try:
+                    self.stop()
+                except Exception:
+                    logging.exception("Stopping the stream failed")
+            elif time.monotonic()-started >= 2*self.hang_timeout:
+                logging.critical("recv() still hung, exiting")
+                logging.shutdown()
+                os._exit(1)
+
+    def stop(self):
+        """Stop the stream"""
+        stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.stop_cont)
+        self.streamer.issue_stream_cmd(stream_cmd)
+
+    def close(self):
+        """Stop the stream and the watchdog"""
+        self.stop_event.set()
+        if self.watchdog is not None:
+            self.watchdog.join()
+        self.stop()
+
+
+class SlotProcessor:
+    """Decimate the received slots and save the records to files
+
+    The time of each decimated sample comes from the sample counter of the
+    USRP, so the decimated samples are on an exact grid of the output
+    sample rate and the records are cut at the multiples of num_samps
+    (e.g. full minutes). Short gaps have been filled with zeros by the
+    receiver. Longer gaps (e.g. after a restart of the stream) are
+    bridged as if zeros had been received, but only the zeros needed to
+    flush the filters are decimated. If the gap is longer than a record,
+    the record is saved and a new one started after the gap. The lost
+    sample ranges are saved with the records that they fall into.
+
+    The channels are decimated together and saved in the same record, so
+    they stay time aligned.
+
+    Returns the time spent decimating the slot, a list of the times spent
+    writing the records saved (s) and the occupancy of the record spool.
+    The processor only reads the slot, so it can also run in a worker
+    process (--dsp-mode process).
+    """
+
+    def __init__(self, decimator, num_samps, rate, channels, freq, gain,
+                 spool):
+        self.decimator = decimator
+        self.spool = spool
+        self.num_samps = num_samps
+        self.rate = rate
+        self.channels = channels
+        self.description = {"rx_rate": rate, "factor": decimator.factor,
+                            "channels": channels, "freq": freq,
+                            "gain": gain}
+        self.fs = rate/decimator.factor
+        self.samples = np.empty((len(channels), num_samps),
+                                dtype=np.complex64)
+        self.nrec = 0               # samples in the current record
+        self.rec_start = 0          # output sample index of the record
+        self.next_out = None        # output sample index of the next output
+        self.next_count = None      # sample counter of the next input
+        self.skip = 0               # outputs left in the filter transient
+        self.gaps = []              # lost (sample counter, length) not saved
+        self.write_times = []       # durations of the record writes
+        # After this many zeros the filters hold nothing but zeros
+        self.flush_samps = 2*decimator.delay+2*decimator.factor
+
+    def restart(self, counter):
+        """Start decimating a new contiguous stream at the sample counter"""
+        dec = self.decimator
+        dec.reset()
+        offset = dec.align(counter)
+        # The output sample index counts the output samples from 1970
+        self.next_out = (counter+offset-dec.delay)//dec.factor
+        # Skip the outputs that depend on samples before the counter
+        self.skip = max(0, -((offset-2*dec.delay)//dec.factor))
+
+    def bridge(self, counter):
+        """Continue after a gap in the stream as if zeros were received"""
+        gap = counter-self.next_count
+        logging.warning("Gap of %d samples in the stream" % gap)
+        if gap < 0:
+            # Not expected, the time of the USRP has jumped back
+            self.end_record()
+            self.restart(counter)
+            return
+        self.gaps.append((self.next_count, gap))
+        nchan = len(self.channels)
+        nflush = min(gap, self.flush_samps)
+        zeros = np.zeros((nchan, nflush), dtype=self.decimator.dtype)
+        self.emit(self.decimator.process(zeros))
+        if nflush == gap:
+            return
+        # The filters hold only zeros now, which is the state after a
+        # reset, and the outputs until the new samples would be zeros
+        dec = self.decimator
+        dec.reset()
+        offset = dec.align(counter)
+        next_out = (counter+offset-dec.delay)//dec.factor
+        hole = next_out-self.next_out
+        if hole <= self.num_samps:
+            self.emit(np.zeros((nchan, hole), dtype=np.complex64))
+        else:
+            self.end_record()
+            self.next_out = next_out
+
+    def __call__(self, slot):
+        self.write_times = []
+        if self.next_count is None:
+            self.restart(slot.start)
+        elif slot.start != self.next_count:
+            self.bridge(slot.start)
+        self.gaps.extend(slot.gaps)
+        self.next_count = slot.start+slot.nsamps
+        started = time.monotonic()
+        y = self.decimator.process(slot.data[:, 0:slot.nsamps])
+        decimate_time = time.monotonic()-started
+        self.emit(y)
+        return decimate_time, self.write_times, self.spool.occupancy()
+
+    def emit(self, y):
+        """Add decimated samples to the records"""
+        n = min(self.skip, y.shape[1])
+        self.skip -= n
+        self.next_out += n
+        y = y[:, n:]
+        while y.shape[1] > 0:
+            # The decimated output may straddle two records
+            if self.nrec == 0:
+                self.rec_start = self.next_out
+            rec_end = (self.rec_start//self.num_samps+1)*self.num_samps
+            real_samps = min(rec_end-self.next_out, y.shape[1])
+            self.samples[:, self.nrec:self.nrec +
+                         real_samps] = y[:, 0:real_samps]
+            self.nrec += real_samps
+            self.next_out += real_samps
+            y = y[:, real_samps:]
+            if self.next_out == rec_end:
+                self.end_record()
+
+    def end_record(self):
+        """Save the samples of the current record, if any"""
+        if self.nrec == 0:
+            return
+        # The gaps before the end of the record (by the sample counter)
+        # go with it, a gap that continues is split at the end. The part
+        # of a gap before the start (a hole between records) is not in it.
+        begin = self.rec_start*self.decimator.factor
+        end = (self.rec_start+self.nrec)*self.decimator.factor
+        gaps = [(max(a, begin), min(a+n, end)-max(a, begin))
+                for a, n in self.gaps if a < end and a+n > begin]
+        self.gaps = [(max(a, end), a+n-max(a, end)) for a, n in self.gaps
+                     if a+n > end]
+        started = time.monotonic()
+        save_record(self.rec_start*self.decimator.factor,
+                    self.samples[:, 0:self.nrec], gaps, self.description,
+                    self.spool)
+        self.write_times.append(time.monotonic()-started)
+        self.nrec = 0
+
+    def close(self):
+        """Save the current record and move the spool to the disk"""
+        self.end_record()
+        self.spool.close()
+
+
+def spill_slot(ring, slot, spill_dir, fs):
+    """Save the raw samples of a slot that could not be processed
+
+    Called in the spill writer thread, so the receive loop does no disk
+    I/O. The spilled slots are counted in the periodic summary.
+    """
+    filename = os.path.join(spill_dir, "doppler-raw-%d" % slot.start)
+    logging.debug("DSP queue full, spilling raw samples to " + filename)
+    try:
+        np.savez(filename, sample_count=slot.start, fs=fs,
+                 samples=slot.data[:, 0:slot.nsamps])
+    except OSError as e:
+        logging.error("Spilling failed: " + str(e))
+    finally:
+        ring.release(slot)
+
+
+def main():
+    global uhd
+    timer = PhaseTimer(_launched)
+    timer.mark("imports")
+    args = parse_args()
+    setup_logging(args.log_file)
+
+    if args.simulate:
+        import sim_uhd as uhd
+
     usrp = uhd.usrp.MultiUSRP(args.args)
+    timer.mark("device")
+
+    # The filters are designed while the USRP is set up, for the rate
+    # that the USRP actually uses. All the sample counts and times are
+    # at that rate.
+    nchan = len(args.channels)
+    rate = set_rate(usrp, args)
+    setup = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    dsp_ready = setup.submit(timer.timed, "filters", prepare_decimation,
+                             args, rate, nchan)
 
     # Use the internal GPSDO
     usrp.set_clock_source("gpsdo")
     usrp.set_time_source("gpsdo")
 
+    # Tune (with the GPSDO reference) while waiting for the PPS edges
+    tuned = setup.submit(timer.timed, "tuning", tune, usrp, args)
+
     # Add here a routine to wait for the system to lock
     ref_status=usrp.get_mboard_sensor("gps_locked",0)
     if ref_status.value:
@@ -83,14 +622,8 @@ def main():
         logging.error("** GPDSO clock not locked?")
 
     # Set the USRP clock date and time from the GPSDO
-    lastt=usrp.get_time_last_pps()
-    nextt=usrp.get_time_last_pps()
-    while nextt==lastt:
-        time.sleep(0.05)
-        lastt=nextt
-        nextt=usrp.get_time_last_pps()
-    time.sleep(0.2)
-    usrp.set_time_next_pps(uhd.libpyuhd.types.time_spec(usrp.get_mboard_sensor("gps_time").to_int()+1))
+    first_start = sync_time(usrp)
+    timer.mark("time sync")
 
     logging.info("USRP clock set to GPSDO time")
     logging.debug(str(usrp.get_mboard_sensor("gps_gpgga")))
@@ -104,73 +637,271 @@ def main():
         logging.debug("pc clock %1.2f usrp clock %1.2f gpsdo %1.2f" % (t_now, t_usrp, t_gpsdo.to_int()))
 
 
-    # Set the USRP rate, freq, and gain
-    usrp.set_rx_rate(args.rate, args.channel)
-    usrp.set_rx_freq(uhd.types.TuneRequest(args.freq), args.channel)
-    usrp.set_rx_gain(args.gain, args.channel)
+    # The samples are decimated in a separate thread, so only the
+    # decimated record needs to be buffered. Each channel is decimated
+    # in its own thread.
+    tuned.result()
+    plan, decimator = dsp_ready.result()
+    setup.shutdown()
+    timer.mark("tuning and filters")
+    logging.info("Decimation " + str(plan))
+    fs_new = plan.output_rate
+    num_samps = int(args.duration*fs_new)
+    logging.debug("One record has " + str(num_samps) + " samples")
 
-    # Create the buffer for received samples
-    num_samps = int(args.duration*args.rate)
-    logging.debug("One buffer records " + str(num_samps) + " samples")
-    samples = np.empty((1, num_samps), dtype=np.complex64)
+    # Configure RX streaming
+    st_args = uhd.usrp.StreamArgs(args.cpu_format, "sc16")
+    st_args.channels = args.channels
 
-    # Configure RX streaming, create a receive buffer
-    st_args = uhd.usrp.StreamArgs("fc32", "sc16")
-    st_args.channels = [args.channel]
+    # Metrics, each updated by one thread only (see telemetry.py)
+    telemetry = Telemetry()
 
-    metadata = uhd.types.RXMetadata()
-    streamer = usrp.get_rx_stream(st_args)
-    buffer_samps = streamer.get_max_num_samps()
-    recv_buffer = np.zeros((1, buffer_samps), dtype=np.complex64)
+    supervisor = StreamSupervisor(usrp, st_args, args.stall_timeout,
+                                  telemetry, args.hang_timeout)
+    metadata = supervisor.metadata
+    buffer_samps = supervisor.streamer.get_max_num_samps()
 
-    stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
-    stream_cmd.stream_now = True
-    streamer.issue_stream_cmd(stream_cmd)
+    # The samples are received into the slots of a ring buffer
+    # (about one second each, whole packets) that are handed over to the
+    # decimation through a bounded queue. The decimator keeps state
+    # between the slots, so there is only one worker.
+    slot_samps = buffer_samps*int(np.ceil(rate/buffer_samps))
+    # The records are written to memory and moved to the disk in batches
+    spool = RecordSpool(args.spool_dir, args.archive_dir,
+                        int(args.spool_quota*1e6), args.spool_interval)
+    processor = SlotProcessor(decimator, num_samps, rate, args.channels,
+                              usrp.get_rx_freq(args.channels[0]),
+                              usrp.get_rx_gain(args.channels[0]), spool)
+    if args.dsp_mode == "process":
+        ring = SharedSampleRing(args.ring_slots, nchan, slot_samps,
+                                decimator.dtype)
+        stage = ProcessStage(ring, processor,
+                             init=functools.partial(setup_logging,
+                                                    args.log_file))
+    else:
+        ring = SampleRing(args.ring_slots, nchan, slot_samps, decimator.dtype)
+        stage = processor
 
-    mytime = time.time()    # Always start from UTC time!
-    mydt = datetime.utcfromtimestamp(mytime)
-    logging.debug("Starting the receiver...")
+    packets = telemetry.counter("packets", "Packets received")
+    samples = telemetry.counter("samples", "Samples received per channel")
+    gaps = telemetry.counter("gaps", "Gaps in the sample counter")
+    lost = telemetry.counter("lost_samples", "Samples missing in the gaps")
+    errors = {code: telemetry.counter("recv_errors", "recv() error codes",
+                                      {"code": name})
+              for name, code in
+              uhd.types.RXMetadataErrorCode.__members__.items()
+              if name not in ("none", "timeout")}
+    records = telemetry.counter("records", "Records saved")
+    recv_time = telemetry.histogram("recv_seconds", "Time per recv() call",
+                                    log_buckets(1e-6, 1.0))
+    dsp_time = telemetry.histogram("decimate_seconds",
+                                   "Decimation time per slot",
+                                   log_buckets(1e-4, 10.0))
+    write_time = telemetry.histogram("write_seconds", "Time per record write",
+                                     log_buckets(1e-4, 10.0))
+
+    # The spool is in the process of the decimation, its state comes back
+    # with the results
+    spool_state = spool.occupancy()
 
+    def process_slot(slot):
+        # The slot goes back to the ring even if the processing fails, or
+        # a few failures would leave the receiver waiting for a slot
+        try:
+            decimate_time, write_times, state = stage(slot)
+        finally:
+            ring.release(slot)
+        spool_state.update(state)
+        dsp_time.observe(decimate_time)
+        for t in write_times:
+            write_time.observe(t)
+            records.inc()
 
-    prev_sample_count = 0
+    spill = None
+    reserved = 0
+    if args.dsp_policy == "spill":
+        # The spilled slots are written by a thread of their own. If that
+        # cannot keep up either, the oldest spilled slot is dropped, so
+        # the spill holds at most two slots (one waiting, one written).
+        os.makedirs(args.spill_dir, exist_ok=True)
+        spill = WorkerPool(lambda slot: spill_slot(ring, slot,
+                                                   args.spill_dir, rate),
+                           workers=1, maxsize=1, policy="drop-oldest",
+                           on_discard=ring.release, name="spill")
+        on_discard = spill.submit
+        reserved = 2
+    else:
+        on_discard = ring.release
+    dsp = WorkerPool(process_slot, workers=1,
+                     maxsize=max(1, args.ring_slots-2-reserved),
+                     policy=args.dsp_policy, on_discard=on_discard,
+                     name="dsp")
+    telemetry.gauge("dsp_queue_depth", "Slots waiting for the decimation",
+                    dsp.depth)
+    telemetry.counter_func("ring_full", "Times the receiver waited for a "
+                           "free slot", lambda: ring.ring_full)
+    telemetry.counter_func("dsp_discarded", "Slots dropped or spilled by the "
+                           "DSP queue policy",
+                           lambda: dsp.dropped+dsp.spilled)
+    if spill is not None:
+        telemetry.counter_func("spill_written", "Spilled slots written to "
+                               "the disk", lambda: spill.done-spill.failed)
+        telemetry.counter_func("spill_dropped", "Spilled slots dropped as "
+                               "the spill writer was behind",
+                               lambda: spill.dropped)
+    telemetry.gauge("spool_bytes", "Bytes of records in the spool",
+                    lambda: spool_state["bytes"])
+    telemetry.gauge("spool_files", "Records in the spool",
+                    lambda: spool_state["files"])
+    telemetry.counter_func("spool_fallbacks", "Records written directly to "
+                           "the disk as the spool was full",
+                           lambda: spool_state["fallbacks"])
+    telemetry.counter_func("spool_migrated", "Records moved from the spool "
+                           "to the disk", lambda: spool_state["migrated"])
+
+    last = {"time": time.monotonic(), "samples": 0, "gaps": 0, "lost": 0,
+            "errors": 0, "restarts": 0, "ring_full": 0, "discarded": 0,
+            "recv_time": recv_time.snapshot()}
+
+    def summary():
+        """Log line of what happened since the previous summary"""
+        now = time.monotonic()
+        nerrors = sum(c.value for c in errors.values())
+        new = {"time": now, "samples": samples.value, "gaps": gaps.value,
+               "lost": lost.value, "errors": nerrors,
+               "restarts": supervisor.restarts.value,
+               "ring_full": ring.ring_full,
+               "discarded": dsp.dropped+dsp.spilled}
+        diff = {k: new[k]-last[k] for k in new}
+        recv_p99 = recv_time.quantile(0.99, since=last["recv_time"])
+        last.update(new, recv_time=recv_time.snapshot())
+        text = ("Receiving %.0f samples/s, %d gaps with %d samples lost, "
+                "%d recv errors, %d restarts, recv p99 %.3gms, ring full "
+                "%d times, %d slots discarded, spool %d records "
+                "%.1f/%.0fMB, DSP %s" %
+                (diff["samples"]/diff["time"], diff["gaps"], diff["lost"],
+                 diff["errors"], diff["restarts"],
+                 1e3*recv_p99, diff["ring_full"],
+                 diff["discarded"], spool_state["files"],
+                 spool_state["bytes"]/1e6, spool_state["quota"]/1e6,
+                 dsp.report()))
+        if spill is not None:
+            text += ", spill " + spill.report()
+        if diff["gaps"] or diff["errors"] or diff["restarts"] or \
+                diff["ring_full"] or diff["discarded"]:
+            return logging.WARNING, text
+        return logging.INFO, text
+
+    telemetry.start(args.metrics_interval, args.metrics_json,
+                    args.metrics_prom, summary)
+
+    # Start the stream on a PPS edge, so that the sample counter (and the
+    # time of every sample) is known from the USRP time stamps
+    supervisor.start(max(first_start, next_start_time(usrp)))
+    timer.mark("stream setup")
+    logging.debug("Starting the receiver...")
+
+    max_fill = int(args.max_gap_fill*rate)
+    next_sample_count = None
+    timeout = uhd.types.RXMetadataErrorCode.timeout
+    # UHD receives only into C-contiguous buffers (into a copy of any
+    # other buffer). With one channel the free end of a slot is one, with
+    # several channels it is not, and the packets are received into a
+    # packet buffer and copied into the slot.
+    packet_buffer = np.empty((nchan, buffer_samps), dtype=decimator.dtype)
+    slot = ring.acquire()
+    exit_code = 0
     try:
         while True:
-            # Receive the samples into the receive buffer
-            # and copy to the actual sample buffer when available
-            logging.debug("Receiving new buffer...")
-            recv_samps = 0
-            while recv_samps < num_samps:
-                samps = streamer.recv(recv_buffer, metadata)
-
-                sample_count = int(metadata.time_spec.get_full_secs())*int(args.rate)+int(metadata.time_spec.get_frac_secs()*args.rate)
-                input_step = sample_count - prev_sample_count
-                if input_step != 363:
-                    logging.error("Dropped a packet!!")
-                prev_sample_count=sample_count
-
-                if metadata.error_code != uhd.types.RXMetadataErrorCode.none:
-                    logging.error(metadata.strerror())
-                if samps:
-                    real_samps = min(num_samps - recv_samps, samps)
-                    samples[:, recv_samps:recv_samps +
-                            real_samps] = recv_buffer[:, 0:real_samps]
-                    recv_samps += real_samps
-
-            if args.fs500:
-                mytime = time.time();
-                x = threading.Thread(target=decimate_500Hz_to_file,
-                                     args=(mytime, samples, args.rate))
+            started = time.perf_counter()
+            # A stalled stream (e.g. stopped after an overflow on a device
+            # that UHD does not restart itself, the N200 is restarted and
+            # only the samples are lost) is restarted by the supervisor
+            target = slot.data[:, slot.nsamps:slot.nsamps+buffer_samps]
+            if target.flags.c_contiguous:
+                samps = supervisor.recv(target)
             else:
-                mytime = time.time();
-                x = threading.Thread(target=decimate_100Hz_to_file,
-                                     args=(mytime, samples, args.rate))
-            x.start()
+                samps = supervisor.recv(packet_buffer)
+                target[:, 0:samps] = packet_buffer[:, 0:samps]
+            recv_time.observe(time.perf_counter()-started)
+
+            if metadata.error_code != uhd.types.RXMetadataErrorCode.none \
+                    and metadata.error_code != timeout:
+                # Logged in the periodic summary, not here
+                errors[metadata.error_code].inc()
+            if samps:
+                packets.inc()
+                samples.inc(samps)
+                sample_count = sample_counter(metadata.time_spec, rate)
+                gap = 0
+                if next_sample_count is not None:
+                    gap = sample_count-next_sample_count
+                else:
+                    timer.mark("first samples")
+                    logging.info("Startup: " + timer.report())
+                if gap:
+                    gaps.inc()
+                    lost.inc(gap)
+                if 0 < gap <= max_fill:
+                    # Short gaps are filled with zeros, so the samples
+                    # stay on the sample clock grid
+                    slot = fill_gap(slot, sample_count, gap, samps, ring,
+                                    dsp)
+                elif gap:
+                    # Each slot has contiguous samples, so the packet
+                    # after a long gap goes to a new slot
+                    if slot.nsamps:
+                        packet = slot.data[:, slot.nsamps:slot.nsamps+samps]
+                        dsp.submit(slot)
+                        slot = ring.acquire()
+                        slot.data[:, 0:samps] = packet
+                next_sample_count = sample_count+samps
+                if slot.start is None:
+                    slot.start = sample_count
+                slot.nsamps += samps
+                if slot.nsamps + buffer_samps > slot_samps:
+                    dsp.submit(slot)
+                    slot = ring.acquire()
+                    if getattr(stage, "failed", False):
+                        # The decimation process keeps dying, let the
+                        # service manager restart the receiver
+                        logging.critical("Decimation process failed, "
+                                         "stopping")
+                        exit_code = 1
+                        break
     except KeyboardInterrupt:
         pass
 
-    stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.stop_cont)
-    streamer.issue_stream_cmd(stream_cmd)
+    supervisor.close()
     logging.info("Stopping the reception")
 
+    # Process and save what has been received so far
+    if slot.nsamps:
+        dsp.submit(slot)
+    dsp.close()
+    if spill is not None:
+        spill.close()
+    stage.close()
+    ring.close()
+    telemetry.stop()
+    telemetry.write(args.metrics_json, args.metrics_prom)
+    logging.info("Received %d packets, %d gaps with %d samples lost "
+                 "(DSP in a %s)" % (packets.value, gaps.value, lost.value,
+                                    args.dsp_mode))
+    if supervisor.restarts.value:
+        logging.warning("Stream restarted %d times (%d new streamers), "
+                        "%.1fs without samples" %
+                        (supervisor.restarts.value,
+                         supervisor.recreations.value,
+                         supervisor.outages.sum))
+    for code, c in errors.items():
+        if c.value:
+            logging.warning("%d recv errors %s" % (c.value, code.name))
+    logging.info("Sample ring was full %d times" % ring.ring_full)
+    if spill is not None:
+        logging.info("Spilled %d slots to %s, %d dropped" %
+                     (spill.done, args.spill_dir, spill.dropped))
+    return exit_code
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -14,7 +14,7 @@ TODO
 import argparse
 import numpy as np
 import uhd
-import scipy.signal as ss
+from decimation import DecimationPlan
 from datetime import datetime
 import time
 import logging
@@ -41,9 +41,9 @@ def parse_args():
 
 def decimate_100Hz_to_file(mytime, samples, fs):
     """Reduce the sample rate before saving to file"""
-    x1 = ss.decimate(samples, 50)
-    x2 = ss.decimate(x1, 50)
-    fs_new = (fs//50)//50
+    plan = DecimationPlan(fs, 100)
+    x2 = plan.decimate(samples)
+    fs_new = plan.output_rate
     mydt = datetime.utcfromtimestamp(mytime)
     filename = "/dev/shm/doppler"+mydt.strftime("%Y-%m-%dT%H:%M:%S")
     logging.debug("Fs=" + str(fs_new) + "Hz " + filename)
@@ -52,9 +52,9 @@ def decimate_100Hz_to_file(mytime, samples, fs):
 
 def decimate_500Hz_to_file(mytime, samples, fs):
     """Reduce the sample rate before saving to file"""
-    x1 = ss.decimate(samples, 50)
-    x2 = ss.decimate(x1, 10)
-    fs_new = (fs//50)//10
+    plan = DecimationPlan(fs, 500)
+    x2 = plan.decimate(samples)
+    fs_new = plan.output_rate
     mydt = datetime.utcfromtimestamp(mytime)
     filename = "/dev/shm/doppler"+mydt.strftime("%Y-%m-%dT%H:%M:%S")
     logging.debug("Fs=" + str(fs_new) + "Hz " + filename)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Low-overhead health metrics of the receiver
+
+The receive loop must not wait for anything, so the metrics are plain
+counters and histograms without locks: each metric is updated by one
+thread only (e.g. the receive loop or the DSP thread), and the other
+threads only read it. A reader may see a value that is one update old,
+which does not matter for monitoring.
+
+PhaseTimer times the start-up of the receiver, phase by phase.
+
+Telemetry collects the metrics. A background thread periodically writes
+them to a JSON file and/or a Prometheus textfile (for the node exporter
+textfile collector) and logs a one-line summary, so that nothing needs
+to be logged from the receive loop itself.
+"""
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+
+class Counter:
+    """Monotonic counter, updated by a single thread"""
+
+    def __init__(self, name, help, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Histogram:
+    """Histogram of values (e.g. durations in s), updated by a single thread
+
+    buckets are the upper bounds of the buckets; larger values are only
+    counted in the total.
+    """
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.counts = [0]*len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        """The bucket counts and the total, for quantile(since=...)"""
+        return list(self.counts), self.count
+
+    def quantile(self, q, since=None):
+        """Upper bound of the bucket holding the q quantile
+
+        The histogram is never reset (the exported counts are cumulative);
+        with since, a snapshot(), only the values observed after it count.
+        """
+        counts, count = self.counts, self.count
+        if since is not None:
+            counts = [n-m for n, m in zip(counts, since[0])]
+            count -= since[1]
+        if count == 0:
+            return 0.0
+        rank = q*count
+        total = 0
+        for bound, n in zip(self.buckets, counts):
+            total += n
+            if total >= rank:
+                return bound
+        return self.max
+
+
+def log_buckets(low, high, per_decade=4):
+    """Logarithmically spaced histogram buckets from low to high"""
+    buckets = []
+    value = low
+    while value < high*1.0001:
+        buckets.append(value)
+        value *= 10**(1/per_decade)
+    return buckets
+
+
+class Telemetry:
+    """Collection of the metrics of the receiver"""
+
+    def __init__(self, prefix="doppler_rx"):
+        self.prefix = prefix
+        self.counters = []
+        self.histograms = []
+        self.gauges = []
+        self.counter_funcs = []
+        self.started = time.time()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def counter(self, name, help, labels=None):
+        """Add a counter"""
+        c = Counter(name, help, labels)
+        self.counters.append(c)
+        return c
+
+    def histogram(self, name, help, buckets):
+        """Add a histogram"""
+        h = Histogram(name, help, buckets)
+        self.histograms.append(h)
+        return h
+
+    def gauge(self, name, help, func):
+        """Add a value that is read with func() when the metrics are written"""
+        self.gauges.append((name, help, func))
+
+    def counter_func(self, name, help, func):
+        """Add a count kept elsewhere, read with func() like a gauge
+
+        The count must only increase; it is exported as a counter.
+        """
+        self.counter_funcs.append((name, help, func))
+
+    def snapshot(self):
+        """Current values of all the metrics as a dictionary"""
+        data = {"time": time.time(), "uptime": time.time()-self.started}
+        for c in self.counters:
+            key = c.name
+            if c.labels:
+                key += "{%s}" % ",".join("%s=%s" % kv
+                                         for kv in sorted(c.labels.items()))
+            data[key] = c.value
+        for name, help, func in self.gauges+self.counter_funcs:
+            data[name] = func()
+        for h in self.histograms:
+            data[h.name] = {"count": h.count, "sum": h.sum, "max": h.max,
+                            "p50": h.quantile(0.5), "p99": h.quantile(0.99),
+                            "buckets": {"%g" % bound: n for bound, n in
+                                        zip(h.buckets, h.counts)}}
+        return data
+
+    def prometheus(self):
+        """The metrics in the Prometheus text format"""
+        lines = []
+        described = set()
+        for c in self.counters:
+            name = "%s_%s_total" % (self.prefix, c.name)
+            if name not in described:
+                lines.append("# HELP %s %s" % (name, c.help))
+                lines.append("# TYPE %s counter" % name)
+                described.add(name)
+            labels = ""
+            if c.labels:
+                labels = "{%s}" % ",".join('%s="%s"' % kv for kv in
+                                           sorted(c.labels.items()))
+            lines.append("%s%s %d" % (name, labels, c.value))
+        for cname, help, func in self.counter_funcs:
+            name = "%s_%s_total" % (self.prefix, cname)
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s counter" % name)
+            lines.append("%s %d" % (name, func()))
+        for gname, help, func in self.gauges:
+            name = "%s_%s" % (self.prefix, gname)
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %g" % (name, func()))
+        for h in self.histograms:
+            name = "%s_%s" % (self.prefix, h.name)
+            lines.append("# HELP %s %s" % (name, h.help))
+            lines.append("# TYPE %s histogram" % name)
+            total = 0
+            for bound, n in zip(h.buckets, h.counts):
+                total += n
+                lines.append('%s_bucket{le="%g"} %d' % (name, bound, total))
+            lines.append('%s_bucket{le="+Inf"} %d' % (name, h.count))
+            lines.append("%s_sum %g" % (name, h.sum))
+            lines.append("%s_count %d" % (name, h.count))
+        return "\n".join(lines)+"\n"
+
+    def write(self, json_file=None, prom_file=None):
+        """Write the metrics to the files (atomically, for the readers)"""
+        for filename, text in ((json_file, lambda: json.dumps(self.snapshot())),
+                               (prom_file, self.prometheus)):
+            if filename is None:
+                continue
+            try:
+                with open(filename+".tmp", "w") as f:
+                    f.write(text())
+                os.replace(filename+".tmp", filename)
+            except OSError as e:
+                logging.error("Writing metrics failed: " + str(e))
+
+    def start(self, interval, json_file=None, prom_file=None, summary=None):
+        """Write the metrics and log summary() every interval seconds"""
+        def run():
+            while not self.stop_event.wait(interval):
+                self.write(json_file, prom_file)
+                if summary is not None:
+                    level, text = summary()
+                    logging.log(level, text)
+        self.thread = threading.Thread(target=run, name="telemetry",
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the periodic writing"""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class PhaseTimer:
+    """Durations of the phases of the start-up, for one log line
+
+    mark() ends a phase of the main thread, record() adds a task that ran
+    in parallel with them. started is the time.monotonic() of the launch.
+    """
+
+    def __init__(self, started=None):
+        self.started = time.monotonic() if started is None else started
+        self.last = self.started
+        self.phases = []
+
+    def mark(self, name):
+        now = time.monotonic()
+        self.phases.append((name, now-self.last))
+        self.last = now
+
+    def record(self, name, seconds):
+        self.phases.append(("(" + name + ")", seconds))
+
+    def timed(self, name, func, *args):
+        """Call func(*args) and record its duration"""
+        started = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            self.record(name, time.monotonic()-started)
+
+    def report(self):
+        """The durations of the phases and the total since the launch"""
+        return "%s, total %.2fs" % (
+            ", ".join("%s %.2fs" % phase for phase in self.phases),
+            time.monotonic()-self.started)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+The receive buffers of streaming_test2.py with several channels
+
+UHD receives only into C-contiguous buffers: a view of a (channels,
+samples) slot is received into a copy, and the samples never reach the
+slot. The simulated USRP (sim_uhd.py) refuses such a buffer, so the
+receiver is run against it with two channels.
+
+    python3 -m unittest test_recv_buffers
+"""
+
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import numpy as np
+import sim_uhd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "DataHandling"))
+from dopplerrecord import read_record
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class SimulatedRecvTest(unittest.TestCase):
+
+    def setUp(self):
+        usrp = sim_uhd.MultiUSRP("seed=1")
+        usrp.set_rx_rate(250e3)
+        stream_args = sim_uhd.StreamArgs("fc32", "sc16")
+        stream_args.channels = [0, 1]
+        self.streamer = usrp.get_rx_stream(stream_args)
+        self.metadata = sim_uhd.RXMetadata()
+        cmd = sim_uhd.StreamCMD(sim_uhd.StreamMode.start_cont)
+        cmd.stream_now = True
+        self.streamer.issue_stream_cmd(cmd)
+
+    def tearDown(self):
+        cmd = sim_uhd.StreamCMD(sim_uhd.StreamMode.stop_cont)
+        self.streamer.issue_stream_cmd(cmd)
+
+    def test_contiguous(self):
+        buffer = np.zeros((2, 1000), dtype=np.complex64)
+        samps = self.streamer.recv(buffer, self.metadata, 1.0)
+        self.assertGreater(samps, 0)
+        self.assertTrue(np.all(buffer[:, 0:samps] != 0))
+
+    def test_not_contiguous(self):
+        slot = np.zeros((2, 10000), dtype=np.complex64)
+        with self.assertRaises(ValueError):
+            self.streamer.recv(slot[:, 100:1100], self.metadata, 1.0)
+
+
+class ReceiverTest(unittest.TestCase):
+
+    def test_two_channels(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dirs = {}
+            for name in ("spool", "archive", "spill"):
+                dirs[name] = os.path.join(tmp, name)
+                os.mkdir(dirs[name])
+            result = subprocess.run(
+                [sys.executable, os.path.join(HERE, "streaming_test2.py"),
+                 "--simulate", "-c", "0", "1", "-d", "10",
+                 "-a", "speed=10,seed=1,duration=25",
+                 "--spool-dir", dirs["spool"],
+                 "--archive-dir", dirs["archive"],
+                 "--spill-dir", dirs["spill"],
+                 "--log-file", os.path.join(tmp, "log.txt")],
+                capture_output=True, text=True, timeout=300)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            records = sorted(glob.glob(os.path.join(dirs["archive"], "**",
+                                                    "*.dope"),
+                                       recursive=True))
+            self.assertGreater(len(records), 0)
+            for filename in records:
+                info, samples, gaps = read_record(filename)
+                self.assertEqual(info["nchannels"], 2)
+                self.assertEqual(len(gaps), 0)
+                # Every decimated sample of both channels has the signal
+                self.assertTrue(np.all(samples != 0), filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
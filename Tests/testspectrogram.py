@@ -11,6 +11,7 @@ Plot a spectrogram of data captured with rx_to_file.py
 """
 
 import scipy.signal as ss
+from decimation import DecimationPlan
 from numpy.fft import fftshift
 import matplotlib.pyplot as plt
 import numpy as np
@@ -51,9 +52,9 @@ def main():
     x = np.load(args.input_file)
     fs = args.rate
     if q > 0:
-        xx = ss.decimate(x, q)
-        fs2 = fs//q
-        plot_spectrogram(xx, fs2)
+        plan = DecimationPlan(fs, fs/q)
+        xx = plan.decimate(x)
+        plot_spectrogram(xx, plan.output_rate)
     else:
         plot_spectrogram(x, fs)
 